@@ -0,0 +1,211 @@
+import json
+import sys
+import time
+from pathlib import Path
+from typing import Callable, List, Optional, Sequence
+
+import lightning as L
+import torch
+
+# support running without installing as a package
+wd = Path(__file__).parent.parent.resolve()
+sys.path.append(str(wd))
+
+from lit_gpt import GPT, Config, Tokenizer
+from lit_gpt.utils import check_valid_checkpoint_dir, get_default_supported_precision, lazy_load
+
+
+def sample(
+    logits: torch.Tensor,
+    temperature: float = 1.0,
+    top_k: Optional[int] = None,
+    top_p: float = 1.0,
+    generator: Optional[torch.Generator] = None,
+) -> torch.Tensor:
+    """Draw one token per row of `logits` of shape (B, vocab_size), the most likely one if `temperature` is 0."""
+    if temperature == 0:
+        return torch.argmax(logits, dim=-1)
+    logits = logits.float() / temperature
+    if top_k is not None:
+        v, _ = torch.topk(logits, min(top_k, logits.size(-1)))
+        logits = logits.masked_fill(logits < v[:, [-1]], -float("inf"))
+    if top_p < 1.0:
+        sorted_logits, sorted_idx = torch.sort(logits, dim=-1, descending=True)
+        probs = torch.softmax(sorted_logits, dim=-1)
+        # drop the tokens after the smallest set whose probability exceeds `top_p`, keeping at least the first
+        remove = probs.cumsum(dim=-1) - probs > top_p
+        logits = logits.scatter(-1, sorted_idx, sorted_logits.masked_fill(remove, -float("inf")))
+    probs = torch.softmax(logits, dim=-1)
+    return torch.multinomial(probs, num_samples=1, generator=generator).squeeze(-1)
+
+
+@torch.inference_mode()
+def generate(
+    model: GPT,
+    prompts: List[torch.Tensor],
+    max_new_tokens: int,
+    *,
+    temperature: float = 1.0,
+    top_k: Optional[int] = None,
+    top_p: float = 1.0,
+    stop_tokens: Sequence[int] = (),
+    callback: Optional[Callable[[torch.Tensor, torch.Tensor], None]] = None,
+    generator: Optional[torch.Generator] = None,
+) -> List[torch.Tensor]:
+    """Generate up to `max_new_tokens` tokens after each of the `prompts`, 1D tensors of token ids, as one batch.
+
+    The prompts are padded on the right to the longest one and processed at once, then the model decodes one token
+    per step for the whole batch, using the KV cache, with every row at its own position. A row stops after one of
+    `stop_tokens`, which is not returned. After each step, `callback` is called with the tokens of the step, of shape
+    (B,), and a mask of the rows that generated them.
+
+    Returns the generated tokens of every prompt.
+    """
+    device = prompts[0].device
+    B = len(prompts)
+    lengths = torch.tensor([len(prompt) for prompt in prompts], device=device)
+    min_length = min(len(prompt) for prompt in prompts)
+    max_length = max(len(prompt) for prompt in prompts)
+    if min_length == 0:
+        raise ValueError("The prompts need at least one token.")
+    if max_length > model.config.block_size:
+        raise ValueError(f"The prompts are longer than the block size {model.config.block_size}.")
+    # past the block size, the KV cache keeps the attention sinks and the most recent positions
+    max_seq_length = min(max_length + max_new_tokens, model.config.block_size)
+
+    tokens = torch.zeros(B, max_length + max_new_tokens, dtype=torch.long, device=device)
+    padding_mask = torch.zeros(B, max_length, dtype=torch.bool, device=device)
+    for i, prompt in enumerate(prompts):
+        tokens[i, : len(prompt)] = prompt
+        padding_mask[i, : len(prompt)] = True
+    rows = torch.arange(B, device=device)
+    stop_tokens = torch.tensor(stop_tokens, dtype=torch.long, device=device)
+    # the first position after the tokens generated for each row
+    ends = lengths + max_new_tokens
+    finished = torch.zeros(B, dtype=torch.bool, device=device)
+
+    model.reset_cache()
+    vocab_size = model.config.vocab_size  # never sample the padding of the embeddings
+    input_pos = torch.arange(max_length, device=device)
+    logits = model(tokens[:, :max_length], max_seq_length, input_pos, padding_mask=padding_mask)
+    logits = logits[rows, lengths - 1, :vocab_size]
+    for step in range(max_new_tokens):
+        positions = lengths + step
+        active = ~finished
+        next_tokens = sample(logits, temperature, top_k, top_p, generator)
+        tokens[rows, positions] = next_tokens
+        stopped = active & torch.isin(next_tokens, stop_tokens)
+        ends = torch.where(stopped, positions, ends)
+        finished |= stopped
+        if callback is not None:
+            callback(next_tokens, active & ~stopped)
+        if step + 1 == max_new_tokens or bool(finished.all()):
+            break
+        logits = model(next_tokens.view(B, 1), max_seq_length, positions.view(B, 1))[:, -1, :vocab_size]
+    model.reset_cache()
+
+    return [tokens[i, start:end] for i, (start, end) in enumerate(zip(lengths.tolist(), ends.tolist()))]
+
+
+def main(
+    prompts: List[str] = ["Hello, my name is"],
+    *,
+    num_samples: int = 1,
+    max_new_tokens: int = 100,
+    temperature: float = 0.8,
+    top_k: Optional[int] = 200,
+    top_p: float = 1.0,
+    checkpoint_dir: Path = Path("checkpoints/TinyLlama/TinyLlama-1.1B-intermediate-step-480k-1T"),
+    checkpoint_path: Optional[Path] = None,
+    accelerator: str = "auto",
+    precision: Optional[str] = None,
+    seed: int = 1234,
+) -> None:
+    """Generates text for the `prompts` as one batch, `num_samples` times.
+
+    Args:
+        prompts: The prompt strings to generate text for.
+        num_samples: The number of batches to generate.
+        max_new_tokens: The number of generation steps to take.
+        temperature: A value controlling the randomness of the sampling process. Higher values result in more random
+            samples, 0 picks the most likely token.
+        top_k: The number of top most probable tokens to consider in the sampling process.
+        top_p: The smallest probability mass of the most probable tokens to consider in the sampling process.
+        checkpoint_dir: The checkpoint directory with `lit_config.json` and the tokenizer.
+        checkpoint_path: The weights to load, `lit_model.pth` in `checkpoint_dir` by default. A checkpoint saved by
+            the pretraining scripts also works.
+        accelerator: The hardware to run on, e.g. "cpu" or "cuda".
+        precision: Indicates the Fabric precision setting to use.
+        seed: The random seed.
+    """
+    precision = precision or get_default_supported_precision(training=False)
+    fabric = L.Fabric(devices=1, accelerator=accelerator, precision=precision)
+
+    check_valid_checkpoint_dir(checkpoint_dir)
+    with open(checkpoint_dir / "lit_config.json") as fp:
+        config = Config(**json.load(fp))
+    checkpoint_path = checkpoint_path or checkpoint_dir / "lit_model.pth"
+
+    fabric.print(f"Loading model {str(checkpoint_path)!r} with {config.__dict__}", file=sys.stderr)
+    t0 = time.perf_counter()
+    with fabric.init_module(empty_init=True):
+        model = GPT(config)
+    with lazy_load(checkpoint_path) as checkpoint:
+        model.load_state_dict(checkpoint.get("model", checkpoint))
+    fabric.print(f"Time to load the model weights: {time.perf_counter() - t0:.02f} seconds.", file=sys.stderr)
+    model.eval()
+    model = fabric.setup_module(model)
+
+    tokenizer = Tokenizer(checkpoint_dir)
+    encoded = [tokenizer.encode(prompt, bos=True, eos=False, device=fabric.device) for prompt in prompts]
+
+    # stream the text of a single prompt, decoded again as it grows since tokens don't always decode separately
+    generated, printed = [], ""
+
+    def stream(next_tokens: torch.Tensor, active: torch.Tensor) -> None:
+        nonlocal printed
+        if active[0]:
+            generated.append(int(next_tokens[0]))
+            text = tokenizer.decode(torch.tensor(generated))
+            fabric.print(text[len(printed) :], end="", flush=True)
+            printed = text
+
+    callback = stream if len(prompts) == 1 else None
+
+    L.seed_everything(seed)
+    for i in range(num_samples):
+        if callback is not None:
+            generated.clear()
+            printed = ""
+            fabric.print(prompts[0], end="", flush=True)
+        t0 = time.perf_counter()
+        outputs = generate(
+            model,
+            encoded,
+            max_new_tokens,
+            temperature=temperature,
+            top_k=top_k,
+            top_p=top_p,
+            stop_tokens=[tokenizer.eos_id],
+            callback=callback,
+        )
+        t = time.perf_counter() - t0
+        if callback is None:
+            for prompt, output in zip(prompts, outputs):
+                fabric.print(prompt + tokenizer.decode(output))
+                fabric.print("-" * 80)
+        else:
+            fabric.print()
+        tokens_generated = sum(len(output) for output in outputs)
+        fabric.print(
+            f"Time for inference {i + 1}: {t:.02f} sec total, {tokens_generated / t:.02f} tokens/sec", file=sys.stderr
+        )
+    if fabric.device.type == "cuda":
+        fabric.print(f"Memory used: {torch.cuda.max_memory_allocated() / 1e9:.02f} GB", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    from jsonargparse import CLI
+
+    torch.set_float32_matmul_precision("high")
+    CLI(main)
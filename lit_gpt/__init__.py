@@ -1,7 +1,7 @@
 from lit_gpt.model import GPT
 from lit_gpt.config import Config
 from lit_gpt.tokenizer import Tokenizer
-from lit_gpt.fused_cross_entropy import FusedCrossEntropyLoss
+from lit_gpt.kernels import CrossEntropyLoss
 from lightning_utilities.core.imports import RequirementCache
 
 if not bool(RequirementCache("torch>=2.1.0dev")):
@@ -17,4 +17,4 @@ if not bool(_LIGHTNING_AVAILABLE):
     )
 
 
-__all__ = ["GPT", "Config", "Tokenizer"]
+__all__ = ["GPT", "Config", "Tokenizer", "CrossEntropyLoss"]
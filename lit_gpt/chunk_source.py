@@ -0,0 +1,143 @@
+"""Reads packed chunks from remote storage through a local disk cache."""
+
+import fcntl
+import os
+import re
+import shutil
+import time
+import urllib.request
+from contextlib import contextmanager
+from urllib.parse import quote
+
+
+class DirectoryTransport:
+    """Copies files from a directory, e.g. a network file system mount."""
+
+    def __init__(self, root):
+        self.root = root
+
+    def fetch(self, name, f):
+        with open(os.path.join(self.root, name), "rb") as src:
+            shutil.copyfileobj(src, f, 1 << 20)
+
+
+class HTTPTransport:
+    """Downloads files from `{base_url}/{name}`, e.g. served by `python -m http.server` or an object store gateway."""
+
+    def __init__(self, base_url, timeout=60.0, retries=3):
+        self.base_url = base_url.rstrip("/")
+        self.timeout = timeout
+        self.retries = retries
+
+    def fetch(self, name, f):
+        for attempt in range(self.retries + 1):
+            try:
+                f.seek(0)
+                f.truncate()
+                with urllib.request.urlopen(f"{self.base_url}/{quote(name)}", timeout=self.timeout) as response:
+                    shutil.copyfileobj(response, f, 1 << 20)
+                return
+            except OSError:
+                if attempt == self.retries:
+                    raise
+                time.sleep(2**attempt)
+
+
+def get_transport(url):
+    """Return the transport for `url`, an `http(s)://` URL or a directory."""
+    # `//` collapses to `/` when a URL is passed through a `Path`
+    url = re.sub(r"^(https?):/+", r"\1://", str(url))
+    if url.startswith(("http://", "https://")):
+        return HTTPTransport(url)
+    return DirectoryTransport(url)
+
+
+class ChunkCache:
+    """Keeps local copies of the files at `url` in `cache_dir`, evicting the least recently used ones to stay under
+    `max_bytes`.
+
+    The cache directory can be shared by all processes on a node: a file is downloaded by the first process that asks
+    for it while the others wait for it, under a lock file per name. Evicting a file that is still mmapped elsewhere
+    is safe, the mapping stays valid until it is closed. A file can be evicted before it is opened, so read it with
+    `open` rather than `path`. `max_bytes` should hold a few windows of chunks per process.
+    """
+
+    def __init__(self, url, cache_dir, max_bytes=1 << 40):
+        self.url = str(url)
+        self.cache_dir = str(cache_dir)
+        self.max_bytes = max_bytes
+        self._transport = None
+        os.makedirs(os.path.join(self.cache_dir, ".locks"), exist_ok=True)
+
+    def __getstate__(self):
+        return {**self.__dict__, "_transport": None}
+
+    @property
+    def transport(self):
+        if self._transport is None:
+            self._transport = get_transport(self.url)
+        return self._transport
+
+    @contextmanager
+    def _lock(self, name):
+        with open(os.path.join(self.cache_dir, ".locks", name + ".lock"), "w") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def path(self, name):
+        """Return the local path of the file `name`, downloading it first if it is not in the cache."""
+        name = os.path.basename(name)
+        path = os.path.join(self.cache_dir, name)
+        while True:
+            if not os.path.isfile(path):
+                with self._lock(name):
+                    # another process may have downloaded it while we waited for the lock
+                    if not os.path.isfile(path):
+                        tmp_path = path + ".tmp"
+                        with open(tmp_path, "wb") as f:
+                            self.transport.fetch(name, f)
+                        os.replace(tmp_path, path)
+                        self._evict(keep=name)
+                        return path
+            try:
+                # the modification time orders the files by their last use
+                os.utime(path)
+                return path
+            except FileNotFoundError:
+                continue  # evicted in the meantime
+
+    def open(self, name, opener):
+        """Return `opener(path)` of the local copy of the file `name`, e.g. `read_chunk`.
+
+        Another process may evict the copy between `path` and opening it, it is then fetched again.
+        """
+        while True:
+            path = self.path(name)
+            try:
+                return opener(path)
+            except FileNotFoundError:
+                if os.path.isfile(path):
+                    raise
+                # evicted before it was opened
+
+    def _evict(self, keep):
+        with self._lock(".evict"):
+            files = []
+            for entry in os.scandir(self.cache_dir):
+                if entry.is_file() and not entry.name.endswith(".tmp"):
+                    stat = entry.stat()
+                    files.append((stat.st_mtime, stat.st_size, entry.name))
+            total = sum(size for _, size, _ in files)
+            for _, size, name in sorted(files):
+                if total <= self.max_bytes:
+                    break
+                if name == keep:
+                    continue
+                try:
+                    os.remove(os.path.join(self.cache_dir, name))
+                except FileNotFoundError:
+                    pass
+                total -= size
@@ -85,13 +85,11 @@ class Config:
     @property
     def norm_class(self) -> Type:
         # `self._norm_class` cannot be the type to keep the config json serializable
-        if self._norm_class == "RMSNorm":
-            from lit_gpt.rmsnorm import RMSNorm
+        if self._norm_class in ("RMSNorm", "FusedRMSNorm"):
+            # the fused kernel where it is available, see `lit_gpt.kernels`
+            from lit_gpt.kernels import RMSNorm
 
             return RMSNorm
-        elif self._norm_class == "FusedRMSNorm":
-            from lit_gpt.rmsnorm import FusedRMSNorm
-            return FusedRMSNorm
         return getattr(torch.nn, self._norm_class)
 
 
@@ -0,0 +1,165 @@
+"""Exact-duplicate detection for documents that are packed by many processes."""
+
+import hashlib
+import json
+import os
+from typing import Dict, List
+
+import numpy as np
+
+META_NAME = "meta.json"
+
+
+def normalize(text: str) -> str:
+    """Normalize case and whitespace, so that documents that only differ in those are duplicates."""
+    return " ".join(text.lower().split())
+
+
+def doc_hash(text: str) -> int:
+    """64 bit hash of the normalized `text`, never 0."""
+    digest = hashlib.blake2b(normalize(text).encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "little") or 1
+
+
+class DedupIndex:
+    """A set of document hashes on disk that is shared by processes.
+
+    The set is an open-addressing hash table with a power of two of slots, each holding the hash of a document, its
+    owner (the source that added it) and its generation (the run that added it). The table is a memmapped file, so it
+    lives in the page cache and not in the memory of the processes. It is kept at most half full, so a lookup reads
+    about 1.5 slots on average, and a new document takes the first empty slot that lookup reaches. When a batch would
+    fill it past half, the documents are moved to a new table with twice the slots, so the file stays within a few
+    times the size of its documents. A batch of documents is looked up together, a few vectorized probes for all of
+    them, so `lock` is only held briefly. Call `create` once, then open the index in every process with the same
+    `lock`.
+    """
+
+    def __init__(self, path: str, lock) -> None:
+        self.path = path
+        self._lock = lock
+        self._open()
+
+    def _open(self) -> None:
+        with open(os.path.join(self.path, META_NAME)) as f:
+            self.capacity = json.load(f)["capacity"]
+        # row 0 keeps the number of documents in the table and the capacity of the table it moved to, if it did
+        self._table = _open_table(self.path, self.capacity)
+
+    @staticmethod
+    def create(path: str, capacity: int = 1 << 20) -> None:
+        """Create an empty index with `capacity` slots to start with, unless `path` already holds one."""
+        if os.path.isfile(os.path.join(path, META_NAME)):
+            return
+        os.makedirs(path, exist_ok=True)
+        capacity = 1 << (capacity - 1).bit_length()
+        _open_table(path, capacity, create=True).flush()
+        _write_meta(path, capacity)
+
+    def __len__(self) -> int:
+        if self._table[0, 1]:
+            self._open()
+        return int(self._table[0, 0])
+
+    def add(self, hashes: List[int], owner: int, generation: int) -> np.ndarray:
+        """Add the documents with `hashes` and return a mask of the ones that were not in the index before.
+
+        A document that `owner` added in an earlier `generation` is not a duplicate: its source is being prepared
+        again after an interrupted run.
+        """
+        hashes = np.asarray(hashes, dtype=np.uint64)
+        keep = np.zeros(len(hashes), dtype=bool)
+        # a document that occurs again in the batch is a duplicate of its first occurrence
+        _, todo = np.unique(hashes, return_index=True)
+        with self._lock:
+            if self._table[0, 1]:
+                # another process moved the documents to a larger table
+                self._open()
+            n_docs = int(self._table[0, 0])
+            if n_docs + len(todo) > self.capacity // 2:
+                self._grow(n_docs + len(todo))
+            mask = np.uint64(self.capacity - 1)
+            slots = hashes[todo] & mask
+            while len(todo):
+                h = hashes[todo]
+                stored = self._table[slots + 1]
+                found = stored[:, 0] == h
+                redo = found & (stored[:, 1] == owner) & (stored[:, 2] != generation)
+                self._table[slots[redo] + 1, 2] = generation
+                keep[todo[redo]] = True
+
+                # of the documents that reach the same empty slot, the first takes it and the others read it again
+                empty = np.flatnonzero(stored[:, 0] == 0)
+                _, first = np.unique(slots[empty], return_index=True)
+                insert = empty[first]
+                self._table[slots[insert] + 1] = np.stack(
+                    [h[insert], np.full(len(insert), owner, np.uint64), np.full(len(insert), generation, np.uint64)],
+                    axis=1,
+                )
+                keep[todo[insert]] = True
+                n_docs += len(insert)
+
+                done = found.copy()
+                done[insert] = True
+                collided = ~found & (stored[:, 0] != 0)
+                slots = np.where(collided, (slots + np.uint64(1)) & mask, slots)
+                todo, slots = todo[~done], slots[~done]
+            self._table[0, 0] = n_docs
+        return keep
+
+    def _grow(self, n_docs: int) -> None:
+        """Move the documents to a table with room for `n_docs` of them. Called with the lock held."""
+        capacity = self.capacity
+        while n_docs > capacity // 2:
+            capacity *= 2
+        table = _open_table(self.path, capacity, create=True)
+        rows = self._table[1:]
+        _insert(table, np.asarray(rows[rows[:, 0] != 0]))
+        table[0, 0] = self._table[0, 0]
+        table.flush()
+        _write_meta(self.path, capacity)
+        # the other processes open the new table on their next batch, their mapping of the old file stays valid
+        self._table[0, 1] = capacity
+        os.remove(_table_path(self.path, self.capacity))
+        self._table, self.capacity = table, capacity
+
+
+def _table_path(path: str, capacity: int) -> str:
+    return os.path.join(path, f"table_{capacity}.bin")
+
+
+def _open_table(path: str, capacity: int, create: bool = False) -> np.memmap:
+    if create:
+        with open(_table_path(path, capacity), "wb") as f:
+            # sparse, disk space is only allocated as the table fills up
+            f.truncate((capacity + 1) * 3 * 8)
+    return np.memmap(_table_path(path, capacity), dtype=np.uint64, mode="r+", shape=(capacity + 1, 3))
+
+
+def _write_meta(path: str, capacity: int) -> None:
+    tmp = os.path.join(path, META_NAME + ".tmp")
+    with open(tmp, "w") as f:
+        json.dump({"capacity": capacity}, f)
+    os.replace(tmp, os.path.join(path, META_NAME))
+
+
+def _insert(table: np.memmap, rows: np.ndarray) -> None:
+    """Insert `rows` of distinct hashes into `table`, which holds none of them."""
+    mask = np.uint64(len(table) - 2)
+    slots = rows[:, 0] & mask
+    while len(rows):
+        empty = np.flatnonzero(table[slots + 1, 0] == 0)
+        _, first = np.unique(slots[empty], return_index=True)
+        insert = empty[first]
+        table[slots[insert] + 1] = rows[insert]
+        done = np.zeros(len(rows), dtype=bool)
+        done[insert] = True
+        # the slots of the rows that are left are all taken now
+        rows, slots = rows[~done], (slots[~done] + np.uint64(1)) & mask
+
+
+def add_counts(counts: Dict[int, List[int]], source_ids: List[int], lengths: List[int]) -> None:
+    """Add the documents and tokens of each source id to `counts`, `{source_id: [documents, tokens]}`."""
+    for source_id, length in zip(source_ids, lengths):
+        count = counts.setdefault(int(source_id), [0, 0])
+        count[0] += 1
+        count[1] += int(length)
@@ -0,0 +1,194 @@
+"""Kernels with a fused CUDA implementation and a pure PyTorch fallback.
+
+The implementation is picked when a kernel is called, not when `lit_gpt` is imported: the fused kernel runs on CUDA
+tensors if its extension can be imported, the PyTorch one everywhere else, e.g. for inference on CPU. Both keep the
+same parameters, so checkpoints load with either of them.
+"""
+
+from functools import lru_cache, partial
+from typing import Callable, Dict, Optional
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
+
+
+def _load_swiglu() -> Callable:
+    from xformers.ops import swiglu
+
+    return swiglu
+
+
+def _load_rope() -> Callable:
+    from lit_gpt.fused_rotary_embedding import apply_rotary_emb_func
+
+    return apply_rotary_emb_func
+
+
+def _load_rms_norm() -> Callable:
+    from lit_gpt.rmsnorm import rms_norm
+
+    return rms_norm
+
+
+def _load_cross_entropy() -> Callable:
+    from lit_gpt.fused_cross_entropy import SoftmaxCrossEntropyLossFn
+
+    return SoftmaxCrossEntropyLossFn.apply
+
+
+# the fused kernels by name, imported on first use
+FUSED_KERNELS: Dict[str, Callable[[], Callable]] = {
+    "swiglu": _load_swiglu,
+    "rope": _load_rope,
+    "rms_norm": _load_rms_norm,
+    "cross_entropy": _load_cross_entropy,
+}
+
+_backend = "auto"
+
+
+def set_backend(backend: str) -> None:
+    """Use the fused kernels where they are available ("auto"), always ("fused") or never ("torch")."""
+    global _backend
+    if backend not in ("auto", "fused", "torch"):
+        raise ValueError(f"Unknown kernel backend {backend!r}.")
+    _backend = backend
+
+
+@lru_cache(maxsize=None)
+def _load_fused(name: str) -> Optional[Callable]:
+    try:
+        return FUSED_KERNELS[name]()
+    except ImportError:
+        return None
+
+
+def fused_kernel(name: str, x: torch.Tensor) -> Optional[Callable]:
+    """Return the fused kernel `name` to run on `x`, or None to run the PyTorch implementation."""
+    if _backend == "torch" or (_backend == "auto" and x.device.type != "cuda"):
+        return None
+    kernel = _load_fused(name)
+    if kernel is None and _backend == "fused":
+        raise RuntimeError(f"The fused {name} kernel is not installed.")
+    return kernel
+
+
+class SwiGLU(nn.Module):
+    """`w3(silu(w1(x)) * w2(x))`, with the parameters of `xformers.ops.SwiGLU(..., _pack_weights=False)`."""
+
+    def __init__(self, in_features: int, hidden_features: int, out_features: Optional[int] = None) -> None:
+        super().__init__()
+        self.w1 = nn.Linear(in_features, hidden_features, bias=False)
+        self.w2 = nn.Linear(in_features, hidden_features, bias=False)
+        self.w3 = nn.Linear(hidden_features, out_features or in_features, bias=False)
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        swiglu = fused_kernel("swiglu", x)
+        if swiglu is not None:
+            return swiglu(x, self.w1.weight, None, self.w2.weight, None, self.w3.weight, None)
+        return self.w3(F.silu(self.w1(x)) * self.w2(x))
+
+
+def apply_rope_(x: torch.Tensor, cos: torch.Tensor, sin: torch.Tensor) -> torch.Tensor:
+    """Rotate the first `2 * cos.size(-1)` channels of `x` of shape (B, T, n_head, head_size) in place.
+
+    The channels are rotated in halves (GPT-NeoX style). `cos` and `sin` have shape (>= T, rotary_dim / 2), or
+    (B, T, rotary_dim / 2) for rows at different positions.
+    """
+    rope = fused_kernel("rope", x) if cos.dim() == 2 else None
+    if rope is not None:
+        return rope(x, cos, sin, False, True)
+    T, d = x.size(1), cos.size(-1)
+    if cos.dim() == 2:
+        cos, sin = cos[:T], sin[:T]
+    # rotate in float32 like the fused kernel
+    cos = cos.unsqueeze(-2).float()
+    sin = sin.unsqueeze(-2).float()
+    x1, x2 = x[..., :d].float(), x[..., d : 2 * d].float()
+    rotated = torch.cat((x1 * cos - x2 * sin, x2 * cos + x1 * sin), dim=-1).to(x.dtype)
+    if torch.is_grad_enabled() and x.requires_grad:
+        # autograd can't rotate the views of `x` in place, e.g. when `x` was split from the qkv projection
+        return torch.cat((rotated, x[..., 2 * d :]), dim=-1)
+    x[..., : 2 * d] = rotated
+    return x
+
+
+class RMSNorm(nn.Module):
+    """Root Mean Square Layer Normalization, normalizing in float32 like the fused kernel."""
+
+    def __init__(self, size: int, dim: int = -1, eps: float = 1e-5) -> None:
+        super().__init__()
+        self.weight = nn.Parameter(torch.ones(size))
+        self.eps = eps
+        self.dim = dim
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        rms_norm = fused_kernel("rms_norm", x) if self.dim in (-1, x.dim() - 1) else None
+        if rms_norm is not None:
+            return rms_norm(x, self.weight, self.eps)
+        x_float = x.float()
+        x_normed = x_float * torch.rsqrt(x_float.pow(2).mean(self.dim, keepdim=True) + self.eps)
+        return (x_normed * self.weight.float()).to(x.dtype)
+
+    def reset_parameters(self) -> None:
+        nn.init.ones_(self.weight)
+
+
+class CrossEntropyLoss(nn.Module):
+    """Cross-entropy of the logits of shape (..., vocab_size), reduced over the targets that are not `ignore_index`.
+
+    The PyTorch implementation computes the loss of `chunk_size` rows at a time, so that only one chunk of the logits
+    is converted to float32 at once. Under autograd the chunks are checkpointed, so their float32 logits are recomputed
+    in the backward rather than kept.
+    """
+
+    def __init__(
+        self,
+        ignore_index: int = -100,
+        reduction: str = "mean",
+        label_smoothing: float = 0.0,
+        inplace_backward: bool = True,
+        chunk_size: int = 4096,
+    ) -> None:
+        super().__init__()
+        if reduction not in ("mean", "none"):
+            raise NotImplementedError("Only support reduction = 'mean' or 'none'")
+        self.ignore_index = ignore_index
+        self.reduction = reduction
+        self.label_smoothing = label_smoothing
+        self.inplace_backward = inplace_backward
+        self.chunk_size = chunk_size
+
+    def forward(self, input: torch.Tensor, target: torch.Tensor) -> torch.Tensor:
+        input = input.reshape(-1, input.size(-1))
+        target = target.reshape(-1)
+        cross_entropy = fused_kernel("cross_entropy", input)
+        if cross_entropy is not None:
+            loss = cross_entropy(
+                input, target, self.label_smoothing, self.ignore_index, self.inplace_backward, None
+            )
+        else:
+            chunk_loss = self._chunk_loss
+            if torch.is_grad_enabled() and input.requires_grad:
+                # recompute the float32 logits of each chunk in the backward instead of keeping those of all chunks
+                chunk_loss = partial(checkpoint, chunk_loss, use_reentrant=False)
+            loss = torch.cat(
+                [
+                    chunk_loss(input_chunk, target_chunk)
+                    for input_chunk, target_chunk in zip(input.split(self.chunk_size), target.split(self.chunk_size))
+                ]
+            )
+        if self.reduction == "mean":
+            return loss.sum() / (target != self.ignore_index).sum()
+        return loss
+
+    def _chunk_loss(self, input: torch.Tensor, target: torch.Tensor) -> torch.Tensor:
+        return F.cross_entropy(
+            input.float(),
+            target,
+            ignore_index=self.ignore_index,
+            reduction="none",
+            label_smoothing=self.label_smoothing,
+        )
@@ -4,21 +4,176 @@ Based on the nanoGPT implementation: https://github.com/karpathy/nanoGPT and
 https://github.com/EleutherAI/gpt-neox/tree/main/megatron/model.
 """
 import math
-from typing import Any, List, Optional, Tuple
+from typing import Any, Dict, List, Optional, Tuple
 
 import torch
 import torch.nn as nn
 from lightning_utilities.core.imports import RequirementCache
 from typing_extensions import Self
-from flash_attn import flash_attn_func
 from lit_gpt.config import Config
-from xformers.ops import SwiGLU
-from .fused_rotary_embedding import apply_rotary_emb_func
+from lit_gpt.kernels import SwiGLU, apply_rope_
 RoPECache = Tuple[torch.Tensor, torch.Tensor]
-KVCache = Tuple[torch.Tensor, torch.Tensor]
 FlashAttention2Available = RequirementCache("flash-attn>=2.0.0.post1")
 
 
+class KVCache:
+    """The keys and values of one layer for `max_seq_length` positions, allocated once in the dtype of the model.
+
+    Once the positions don't fit, the cache is a ring buffer that keeps the first `sink_size` positions, the attention
+    sinks (https://arxiv.org/abs/2309.17453), and overwrites the oldest of the others. The keys are stored rotated for
+    their positions, and the sink keys are rotated again to sit right before the oldest position that is left, so that
+    the model never sees a distance longer than `max_seq_length`.
+    """
+
+    def __init__(
+        self,
+        k_shape: Tuple[int, ...],
+        v_shape: Tuple[int, ...],
+        sink_size: int,
+        device: Optional[torch.device] = None,
+        dtype: Optional[torch.dtype] = None,
+    ) -> None:
+        self.k = torch.zeros(k_shape, device=device, dtype=dtype)
+        self.v = torch.zeros(v_shape, device=device, dtype=dtype)
+        self.max_seq_length = k_shape[1]
+        self.sink_size = sink_size
+        # the sink keys rotated for their own positions
+        self.sink_k = torch.zeros_like(self.k[:, :sink_size])
+
+    def update(self, slots: torch.Tensor, k: torch.Tensor, v: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Write `k` and `v` to the `slots` of shape (T,), shared by all rows, or (B, T)."""
+        if slots.dim() == 1:
+            self.k.index_copy_(1, slots, k)
+            self.v.index_copy_(1, slots, v)
+        else:
+            rows = torch.arange(slots.size(0), device=slots.device).unsqueeze(-1)
+            self.k[rows, slots] = k
+            self.v[rows, slots] = v
+        return self.k, self.v
+
+    def save_sinks(self, rows: torch.Tensor) -> None:
+        """Save the sinks of the `rows`, a boolean of shape (B,) or () for all rows."""
+        sinks = self.k[:, : self.sink_size]
+        self.sink_k.copy_(torch.where(rows.view(-1, 1, 1, 1), sinks, self.sink_k))
+
+    def shift_sinks(self, rope: RoPECache) -> None:
+        sinks = self.k[:, : self.sink_size]
+        sinks.copy_(self.sink_k)
+        apply_rope_(sinks, *rope)
+
+
+class BlockAllocator:
+    """Hands out the ids of `num_blocks` blocks from a free list, in O(1) per block."""
+
+    def __init__(self, num_blocks: int) -> None:
+        self.num_blocks = num_blocks
+        self.free_blocks = list(range(num_blocks - 1, -1, -1))
+
+    def allocate(self) -> int:
+        if not self.free_blocks:
+            raise RuntimeError(f"All {self.num_blocks} blocks of the KV cache are in use.")
+        return self.free_blocks.pop()
+
+    def free(self, block: int) -> None:
+        self.free_blocks.append(block)
+
+
+class PagedKVCache:
+    """The keys and values of all layers for many sequences, in blocks of `page_size` positions from a shared pool.
+
+    A sequence takes blocks as it grows and returns them when it is freed, so the memory used follows the lengths of
+    the sequences instead of the longest one. The block table of a sequence lists its blocks in order. Pass the ids of
+    the sequences of a batch to `GPT.forward(idx, seq_ids=...)` to append `idx` to them.
+    """
+
+    def __init__(
+        self,
+        n_layer: int,
+        num_blocks: int,
+        page_size: int,
+        heads: int,
+        head_size: int,
+        device: Optional[torch.device] = None,
+        dtype: Optional[torch.dtype] = None,
+    ) -> None:
+        shape = (n_layer, num_blocks * page_size, heads, head_size)
+        self.k = torch.zeros(shape, device=device, dtype=dtype)
+        self.v = torch.zeros(shape, device=device, dtype=dtype)
+        self.page_size = page_size
+        self.allocator = BlockAllocator(num_blocks)
+        self.block_tables: Dict[Any, List[int]] = {}
+        self.lengths: Dict[Any, int] = {}
+        # the slots of the cache that the positions of the current batch are gathered from
+        self.gather_index: Optional[torch.Tensor] = None
+
+    def append(self, seq_ids: List[Any], T: int) -> List[int]:
+        """Make room for `T` more positions in each of the sequences `seq_ids`, adding new ones, and return the first
+        position of each."""
+        starts = [self.lengths.get(seq_id, 0) for seq_id in seq_ids]
+        needed = [
+            -(-(start + T) // self.page_size) - len(self.block_tables.get(seq_id, ()))
+            for seq_id, start in zip(seq_ids, starts)
+        ]
+        if sum(needed) > len(self.allocator.free_blocks):
+            raise RuntimeError(
+                f"The KV cache needs {sum(needed)} more blocks, {len(self.allocator.free_blocks)} of"
+                f" {self.allocator.num_blocks} are free."
+            )
+        for seq_id, start, n in zip(seq_ids, starts, needed):
+            blocks = self.block_tables.setdefault(seq_id, [])
+            blocks.extend(self.allocator.allocate() for _ in range(n))
+            self.lengths[seq_id] = start + T
+        return starts
+
+    def free(self, seq_id: Any) -> None:
+        for block in self.block_tables.pop(seq_id, []):
+            self.allocator.free(block)
+        self.lengths.pop(seq_id, None)
+
+    def index(self, seq_ids: List[Any], input_pos: torch.Tensor) -> torch.Tensor:
+        """Return the slots of the cache to write the positions `input_pos` of shape (B, T) of the sequences to.
+
+        Also sets `gather_index`, the slots of all the positions of each sequence, that the layers read them from.
+        """
+        max_blocks = max(len(self.block_tables[seq_id]) for seq_id in seq_ids)
+        # pad with the first block, the positions past the end of a sequence are masked out
+        tables = [self.block_tables[seq_id] + [0] * (max_blocks - len(self.block_tables[seq_id])) for seq_id in seq_ids]
+        tables = torch.tensor(tables, device=input_pos.device)
+        offsets = torch.arange(self.page_size, device=input_pos.device)
+        self.gather_index = (tables.unsqueeze(-1) * self.page_size + offsets).flatten(1)
+        return self.gather_index.gather(1, input_pos).flatten()
+
+    def layer(self, i: int) -> "PagedKVCacheLayer":
+        return PagedKVCacheLayer(self, i)
+
+    def memory_stats(self) -> Dict[str, int]:
+        bytes_per_block = 2 * self.k[:, : self.page_size].numel() * self.k.element_size()
+        used_blocks = self.allocator.num_blocks - len(self.allocator.free_blocks)
+        return {
+            "sequences": len(self.lengths),
+            "tokens": sum(self.lengths.values()),
+            "used_blocks": used_blocks,
+            "free_blocks": len(self.allocator.free_blocks),
+            "used_bytes": used_blocks * bytes_per_block,
+            "total_bytes": self.allocator.num_blocks * bytes_per_block,
+        }
+
+
+class PagedKVCacheLayer:
+    """The view of one layer of a `PagedKVCache` that `CausalSelfAttention` writes to and gathers from."""
+
+    def __init__(self, cache: PagedKVCache, layer: int) -> None:
+        self.cache = cache
+        self.layer = layer
+
+    def update(self, slots: torch.Tensor, k: torch.Tensor, v: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        cache_k, cache_v = self.cache.k[self.layer], self.cache.v[self.layer]
+        cache_k.index_copy_(0, slots, k.flatten(0, 1))
+        cache_v.index_copy_(0, slots, v.flatten(0, 1))
+        # (B, max_blocks * page_size, heads, head_size), in the order of the positions
+        return cache_k[self.cache.gather_index], cache_v[self.cache.gather_index]
+
+
 class GPT(nn.Module):
     def __init__(self, config: Config) -> None:
         super().__init__()
@@ -36,6 +191,9 @@ class GPT(nn.Module):
         self.rope_cache: Optional[RoPECache] = None
         self.mask_cache: Optional[torch.Tensor] = None
         self.kv_caches: List[KVCache] = []
+        # the position held by each slot of the KV caches, -1 if the slot is empty
+        self.kv_cache_positions: Optional[torch.Tensor] = None
+        self.paged_kv_cache: Optional[PagedKVCache] = None
 
     def _init_weights(self, module: nn.Module, n_layer) -> None:
         """Meant to be used with `gpt.apply(gpt._init_weights)`."""
@@ -56,14 +214,30 @@ class GPT(nn.Module):
 
     def reset_cache(self) -> None:
         self.kv_caches.clear()
-        if self.mask_cache is not None and self.mask_cache.device.type == "xla":
+        self.kv_cache_positions = None
+        if self.rope_cache is not None and self.rope_cache[0].device.type == "xla":
             # https://github.com/Lightning-AI/lit-gpt/pull/83#issuecomment-1558150179
             self.rope_cache = None
             self.mask_cache = None
 
     def forward(
-        self, idx: torch.Tensor, max_seq_length: Optional[int] = None, input_pos: Optional[torch.Tensor] = None
+        self,
+        idx: torch.Tensor,
+        max_seq_length: Optional[int] = None,
+        input_pos: Optional[torch.Tensor] = None,
+        seq_ids: Optional[List[Any]] = None,
+        padding_mask: Optional[torch.Tensor] = None,
     ) -> torch.Tensor:
+        """With `input_pos`, process the tokens of `idx` at the positions `input_pos` with the KV caches. The positions
+        are shared by all rows, of shape (T,), or per row, of shape (B, T), e.g. for sequences of different lengths.
+        With `seq_ids`, append each row of `idx` to its sequence in `self.paged_kv_cache`.
+
+        `padding_mask` of shape (B, T) is False for the padding tokens of `idx`, which no token attends to. Without
+        `input_pos`, the positions of each row only count its tokens that are not padding, so that it may be padded on
+        either side. With the KV caches, a padding token only takes the slot of its position until it is overwritten.
+        """
+        if seq_ids is not None:
+            return self.forward_paged(idx, seq_ids)
         B, T = idx.size()
         use_kv_cache = input_pos is not None
 
@@ -79,39 +253,76 @@ class GPT(nn.Module):
 
         if self.rope_cache is None:
             self.rope_cache = self.build_rope_cache(idx)
-        # passing `attn_mask` to SDPA downgrades it to use the inefficient implementation. since we only need the mask
-        # for the kv-cache support (only during inference), we only create it in that situation
-        # this will be resolved by https://github.com/pytorch/pytorch/issues/96099
-        if use_kv_cache and self.mask_cache is None:
-            self.mask_cache = self.build_mask_cache(idx)
 
         cos, sin = self.rope_cache
-        if use_kv_cache:
-
-            cos = cos.index_select(0, input_pos)
-            sin = sin.index_select(0, input_pos)
-            mask = self.mask_cache.index_select(2, input_pos)
-            mask = mask[:, :, :, :max_seq_length]
-        else:
-            cos = cos[:T]
-            sin = sin[:T]
-            mask = None
+        if not use_kv_cache:
+            if padding_mask is None:
+                cos, sin, mask = cos[:T], sin[:T], None
+            else:
+                positions = (padding_mask.cumsum(-1) - 1).clamp(min=0)
+                cos, sin = cos[positions], sin[positions]
+                mask = self.padding_attention_mask(padding_mask)
 
         # forward the model itself
         x = self.transformer.wte(idx)  # token embeddings of shape (b, t, n_embd)
             
         if not use_kv_cache:
             for block in self.transformer.h:
-                x, *_ = block(x, (cos, sin), max_seq_length)
+                x, *_ = block(x, (cos, sin), max_seq_length, mask)
         else:
             self.kv_caches = self.kv_caches or self.build_kv_caches(x, max_seq_length, cos.size(-1) * 2)
+            first_pos, last_pos = torch.stack((input_pos[..., 0].min(), input_pos[..., -1].max())).tolist()
+            if last_pos < cos.size(0):
+                # (T, rotary_dim / 2), or (B, T, rotary_dim / 2) for per-row positions
+                cos, sin = cos[input_pos], sin[input_pos]
+            else:
+                # past the block size, e.g. in a long chat with a full cache
+                cos, sin = self.build_rope(input_pos, cos.dtype)
+            slots, mask = self.kv_cache_slots(input_pos, padding_mask, first_pos, last_pos)
+            # move the attention sinks right before the oldest position in the cache, of each row
+            sink_size = self.kv_caches[0].sink_size
+            if sink_size and last_pos + 1 > self.kv_caches[0].max_seq_length:
+                sink_shift = (input_pos[..., -1] + 1 - self.kv_caches[0].max_seq_length).clamp(min=0)
+                sink_shift = sink_shift.unsqueeze(-1).expand(*sink_shift.shape, sink_size)
+                sink_rope = self.build_rope(sink_shift, cos.dtype)
+                for kv_cache in self.kv_caches:
+                    kv_cache.shift_sinks(sink_rope)
             for i, block in enumerate(self.transformer.h):
-                x, self.kv_caches[i] = block(x, (cos, sin), max_seq_length, mask, input_pos, self.kv_caches[i])
+                x, self.kv_caches[i] = block(x, (cos, sin), max_seq_length, mask, slots, self.kv_caches[i])
+            if first_pos < sink_size:
+                for kv_cache in self.kv_caches:
+                    kv_cache.save_sinks(input_pos[..., 0] < sink_size)
 
         x = self.transformer.ln_f(x)
 
         return self.lm_head(x)  # (b, t, vocab_size)
 
+    def forward_paged(self, idx: torch.Tensor, seq_ids: List[Any]) -> torch.Tensor:
+        cache = self.paged_kv_cache
+        if cache is None:
+            raise RuntimeError("Set `paged_kv_cache`, e.g. with `build_paged_kv_cache`, to forward sequences by id.")
+        B, T = idx.size()
+        starts = cache.append(seq_ids, T)
+        input_pos = torch.tensor(starts, device=idx.device).unsqueeze(-1) + torch.arange(T, device=idx.device)
+        slots = cache.index(seq_ids, input_pos)
+
+        if self.rope_cache is None:
+            self.rope_cache = self.build_rope_cache(idx)
+        cos, sin = self.rope_cache
+        if max(starts) + T <= cos.size(0):
+            cos, sin = cos[input_pos], sin[input_pos]
+        else:
+            cos, sin = self.build_rope(input_pos, cos.dtype)
+        # (B, 1, T, max_blocks * page_size), the gathered positions up to the position of each query
+        mask = torch.arange(cache.gather_index.size(1), device=idx.device) <= input_pos.unsqueeze(-1)
+        mask = mask.unsqueeze(1)
+
+        x = self.transformer.wte(idx)
+        for i, block in enumerate(self.transformer.h):
+            x, _ = block(x, (cos, sin), T, mask, slots, cache.layer(i))
+        x = self.transformer.ln_f(x)
+        return self.lm_head(x)
+
     @classmethod
     def from_name(cls, name: str, **kwargs: Any) -> Self:
         return cls(Config.from_name(name, **kwargs))
@@ -125,11 +336,71 @@ class GPT(nn.Module):
             condense_ratio=self.config.condense_ratio,
         )
 
+    def build_rope(self, positions: torch.Tensor, dtype: torch.dtype) -> RoPECache:
+        return rope_at(
+            positions,
+            n_elem=int(self.config.rotary_percentage * self.config.head_size),
+            dtype=dtype,
+            condense_ratio=self.config.condense_ratio,
+        )
+
+    def kv_cache_slots(
+        self, input_pos: torch.Tensor, padding_mask: Optional[torch.Tensor], first_pos: int, last_pos: int
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Return the slots of the KV caches to write the positions `input_pos` to, and the attention mask over the
+        slots for them.
+
+        The positions held by the slots are tracked for the whole batch while all rows share them, so the mask is
+        (1, 1, T, max_seq_length), and per row, (B, 1, T, max_seq_length), once a batch is ragged.
+        """
+        max_seq_length, sink_size = self.kv_caches[0].max_seq_length, self.kv_caches[0].sink_size
+        window = max_seq_length - sink_size
+        T = input_pos.size(-1)
+        if last_pos >= max_seq_length and T > window:
+            raise ValueError(f"Cannot forward {T} positions at once past the {window} positions of the ring buffer.")
+        if self.kv_cache_positions is None:
+            self.kv_cache_positions = torch.full((1, max_seq_length), -1, dtype=torch.long, device=input_pos.device)
+        ragged = input_pos.dim() == 2 or padding_mask is not None
+        if ragged and self.kv_cache_positions.size(0) == 1:
+            B = self.kv_caches[0].k.size(0)
+            self.kv_cache_positions = self.kv_cache_positions.expand(B, -1).clone()
+        positions = self.kv_cache_positions
+        if first_pos == 0:
+            # the rows that start over forget their previous positions
+            positions.masked_fill_(input_pos[..., :1] == 0, -1)
+
+        slots = torch.where(input_pos < sink_size, input_pos, sink_size + (input_pos - sink_size) % window)
+        # the slots of padding tokens hold no position
+        held = input_pos if padding_mask is None else input_pos.masked_fill(~padding_mask, -1)
+        if slots.dim() == 1:
+            positions.index_copy_(1, slots, held.expand(positions.size(0), T))
+        else:
+            positions.scatter_(1, slots, held)
+
+        positions = positions.unsqueeze(1)
+        mask = (positions >= 0) & (positions <= input_pos.unsqueeze(-1))
+        if padding_mask is not None:
+            # padding tokens attend to their own slot, so that no row of the mask is empty
+            own_slot = torch.arange(max_seq_length, device=slots.device) == slots.unsqueeze(-1)
+            mask |= own_slot
+        return slots, mask.unsqueeze(1)
+
+    def padding_attention_mask(self, padding_mask: torch.Tensor) -> torch.Tensor:
+        """The causal attention mask of shape (B, 1, T, T) that hides the padding tokens of `padding_mask` (B, T)."""
+        T = padding_mask.size(-1)
+        ones = torch.ones((T, T), device=padding_mask.device, dtype=torch.bool)
+        mask = torch.tril(ones) & padding_mask.unsqueeze(1)
+        # padding tokens attend to themselves, so that no row of the mask is empty
+        mask |= torch.eye(T, device=padding_mask.device, dtype=torch.bool)
+        return mask.unsqueeze(1)
+
     def build_mask_cache(self, idx: torch.Tensor) -> torch.Tensor:
         ones = torch.ones((self.config.block_size, self.config.block_size), device=idx.device, dtype=torch.bool)
         return torch.tril(ones).unsqueeze(0).unsqueeze(0)
 
-    def build_kv_caches(self, idx: torch.Tensor, max_seq_length: int, rope_cache_length: int) -> List[KVCache]:
+    def build_kv_caches(
+        self, idx: torch.Tensor, max_seq_length: int, rope_cache_length: int, sink_size: int = 4
+    ) -> List[KVCache]:
         B = idx.size(0)
         heads = 1 if self.config.n_query_groups == 1 else self.config.n_query_groups
 
@@ -140,13 +411,33 @@ class GPT(nn.Module):
             rope_cache_length + self.config.head_size - int(self.config.rotary_percentage * self.config.head_size),
         )
         v_cache_shape = (B, max_seq_length, heads, self.config.head_size)
-        device = idx.device
+        sink_size = min(sink_size, max_seq_length - 1)
         return [
-            (torch.zeros(k_cache_shape, device=device), torch.zeros(v_cache_shape, device=device))
+            KVCache(k_cache_shape, v_cache_shape, sink_size, device=idx.device, dtype=idx.dtype)
             for _ in range(self.config.n_layer)
         ]
 
 
+    def build_paged_kv_cache(
+        self,
+        num_blocks: int,
+        page_size: int = 16,
+        device: Optional[torch.device] = None,
+        dtype: Optional[torch.dtype] = None,
+    ) -> PagedKVCache:
+        heads = 1 if self.config.n_query_groups == 1 else self.config.n_query_groups
+        weight = self.transformer.wte.weight
+        return PagedKVCache(
+            self.config.n_layer,
+            num_blocks,
+            page_size,
+            heads,
+            self.config.head_size,
+            device=device or weight.device,
+            dtype=dtype or weight.dtype,
+        )
+
+
 class Block(nn.Module):
     def __init__(self, config: Config) -> None:
         super().__init__()
@@ -231,8 +522,8 @@ class CausalSelfAttention(nn.Module):
 
         # apply rope in fp32 significanly stabalize training
         # fused rope expect (batch_size, seqlen, nheads, headdim)
-        q = apply_rotary_emb_func(q, cos, sin, False, True)
-        k = apply_rotary_emb_func(k, cos, sin, False, True)
+        q = apply_rope_(q, cos, sin)
+        k = apply_rope_(k, cos, sin)
         
         # n_elem = int(self.config.rotary_percentage * self.config.head_size)
     
@@ -243,18 +534,8 @@ class CausalSelfAttention(nn.Module):
         # k = torch.cat((k_roped, k[..., n_elem:]), dim=-1)
 
         if kv_cache is not None:
-            cache_k, cache_v = kv_cache
-            cache_k, cache_v = cache_k.to(dtype=k.dtype), cache_v.to(dtype=v.dtype)
-            # check if reached token limit
-            if input_pos[-1] >= max_seq_length:
-                input_pos = torch.tensor(max_seq_length - 1, device=input_pos.device)
-                # shift 1 position to the left
-                cache_k = torch.roll(cache_k, -1, dims=1)
-                cache_v = torch.roll(cache_v, -1, dims=1)
-
-            k = cache_k.index_copy_(1, input_pos, k)
-            v = cache_v.index_copy_(1, input_pos, v)
-            kv_cache = k, v
+            # `input_pos` are the slots of the cache to write to
+            k, v = kv_cache.update(input_pos, k, v)
 
         y = self.scaled_dot_product_attention(q, k, v, mask=mask)
 
@@ -309,7 +590,7 @@ class LLaMAMLP(nn.Module):
         # self.fc_1 = nn.Linear(config.n_embd, config.intermediate_size, bias=config.bias)
         # self.fc_2 = nn.Linear(config.n_embd, config.intermediate_size, bias=config.bias)
         # self.proj = nn.Linear(config.intermediate_size, config.n_embd, bias=config.bias)
-        self.swiglu = SwiGLU(config.n_embd,config.intermediate_size, bias=False, _pack_weights=False)
+        self.swiglu = SwiGLU(config.n_embd, config.intermediate_size)
     def forward(self, x: torch.Tensor) -> torch.Tensor:
         # x_fc_1 = self.fc_1(x)
         # x_fc_2 = self.fc_2(x)
@@ -347,6 +628,16 @@ def build_rope_cache(
     return cos, sin
 
 
+def rope_at(
+    positions: torch.Tensor, n_elem: int, dtype: torch.dtype, base: int = 10000, condense_ratio: int = 1
+) -> RoPECache:
+    """The rows of `build_rope_cache` for any `positions`, with the angles computed in float64 to stay accurate for
+    positions far past the block size."""
+    theta = 1.0 / (base ** (torch.arange(0, n_elem, 2, device=positions.device, dtype=torch.float64) / n_elem))
+    idx_theta = (positions.to(torch.float64) / condense_ratio).unsqueeze(-1) * theta
+    return torch.cos(idx_theta).to(dtype), torch.sin(idx_theta).to(dtype)
+
+
 def apply_rope(x: torch.Tensor, cos: torch.Tensor, sin: torch.Tensor) -> torch.Tensor:
     head_size = x.size(-1)
     x1 = x[..., : head_size // 2]  # (B, nh, T, hs/2)
@@ -2,13 +2,22 @@
 # https://github.com/NVIDIA/Megatron-LM/blob/main/megatron/data/indexed_dataset.py
 
 
+import bisect
+import glob
 import os
-import random
 import struct
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import reduce
 
 import numpy as np
 import torch
-from torch.utils.data import IterableDataset, get_worker_info
+from torch.utils.data import Dataset, IterableDataset, Sampler, get_worker_info
+
+try:
+    from mmap import MADV_WILLNEED
+except ImportError:  # not available on this platform, the pages are touched instead
+    MADV_WILLNEED = None
 
 dtypes = {1: np.uint8, 2: np.int8, 3: np.int16, 4: np.int32, 5: np.int64, 6: np.float32, 7: np.float64, 8: np.uint16}
 
@@ -23,11 +32,297 @@ def code(dtype):
 HDR_MAGIC = b"LITPKDS"
 HDR_SIZE = 24  # bytes
 
+# One manifest per data directory lists every chunk with its header fields and token statistics, so that loaders
+# never have to glob the directory or open each chunk to read its header.
+MANIFEST_NAME = "manifest.npy"
+MANIFEST_PART_SUFFIX = ".manifest.npy"
+MANIFEST_FILENAME_SIZE = 128  # bytes
+MANIFEST_DTYPE = np.dtype(
+    [
+        ("filename", f"S{MANIFEST_FILENAME_SIZE}"),
+        ("dtype", "<u1"),
+        ("chunk_size", "<u8"),
+        ("n_tokens", "<u8"),  # tokens written by the builder, the rest of the chunk is `sep_token` padding
+        ("n_docs", "<u8"),  # documents starting in this chunk
+        ("n_sep", "<u8"),  # occurrences of `sep_token` (BOS/EOS separators and padding)
+    ]
+)
+
+
+# Next to each chunk the builder writes a document index, a (2, n_docs) uint32 array with the deltas between the
+# offsets at which documents start in the chunk (the first one relative to 0) and the source id of each document.
+# A chunk whose first start is not 0 begins with the tail of a document of the previous chunk.
+DOC_INDEX_SUFFIX = ".docs.npy"
+
+
+def doc_index_path(path):
+    return os.path.splitext(path)[0] + DOC_INDEX_SUFFIX
+
+
+def write_doc_index(path, doc_starts, doc_sources):
+    """Write the document index of the chunk at `path` from the absolute start offsets of its documents."""
+    with open(doc_index_path(path), "wb") as f:
+        np.save(f, np.array([np.diff(doc_starts, prepend=0), doc_sources], dtype=np.uint32))
+
+
+def read_doc_index(path):
+    """Return the start offsets and source ids of the documents starting in the chunk at `path`."""
+    deltas, source_ids = np.load(doc_index_path(path), mmap_mode="r")
+    return np.cumsum(deltas, dtype=np.int64), source_ids
+
+
+def read_header(path):
+    with open(path, "rb") as f:
+        magic = f.read(len(HDR_MAGIC))
+        assert magic == HDR_MAGIC, "File doesn't match expected format."
+        version = struct.unpack("<Q", f.read(8))
+        assert version in ((1,), (2,))
+        (dtype_code,) = struct.unpack("<B", f.read(1))
+        dtype = dtypes[dtype_code]
+        (chunk_size,) = struct.unpack("<Q", f.read(8))
+    return dtype, chunk_size
+
+
+# Version 2 chunks store the tokens as independently compressed frames of `frame_size` tokens. The version 1 header
+# is followed by the codec, the bit width of "bitpack", the frame size, the number of frames and the file offsets of
+# every frame and of the end of the last one, so that a range of tokens is read by decompressing only its frames.
+HDR_V2_FORMAT = "<7sQBQBBQQ"
+HDR_V2_SIZE = struct.calcsize(HDR_V2_FORMAT)
+DEFAULT_FRAME_SIZE = 1 << 16  # tokens
+codecs = {1: "zstd", 2: "bitpack"}
+
+
+def codec_code(codec):
+    for k in codecs:
+        if codecs[k] == codec:
+            return k
+    raise ValueError(codec)
+
+
+def _pack_bits(arr, bits):
+    # keep the low `bits` bits of each token, e.g. 15 bits for a 32000 token vocabulary
+    arr_bits = np.unpackbits(arr.astype(">u4").view(np.uint8).reshape(-1, 4), axis=1)
+    return np.packbits(arr_bits[:, 32 - bits :]).tobytes()
+
+
+def _unpack_bits(buffer, bits, count, dtype):
+    arr_bits = np.zeros((count, 32), dtype=np.uint8)
+    arr_bits[:, 32 - bits :] = np.unpackbits(np.frombuffer(buffer, dtype=np.uint8), count=count * bits).reshape(
+        count, bits
+    )
+    return np.packbits(arr_bits, axis=1).view(">u4").ravel().astype(dtype)
+
+
+def write_chunk(f, arr, codec=None, frame_size=DEFAULT_FRAME_SIZE, level=3):
+    """Write the tokens `arr` as a version 1 chunk, or as a version 2 chunk compressed with `codec`."""
+    f.write(HDR_MAGIC)
+    f.write(struct.pack("<Q", 1 if codec is None else 2))
+    f.write(struct.pack("<B", code(arr.dtype.type)))
+    f.write(struct.pack("<Q", len(arr)))
+    if codec is None:
+        f.write(memoryview(np.ascontiguousarray(arr)).cast("B"))
+        return
+
+    bits = 0
+    if codec == "zstd":
+        import zstandard as zstd
+
+        compress = zstd.ZstdCompressor(level=level).compress
+    elif codec == "bitpack":
+        if np.issubdtype(arr.dtype, np.floating) or (len(arr) and arr.min() < 0):
+            raise ValueError("Only non-negative integer tokens can be bit-packed.")
+        bits = max(int(arr.max()).bit_length(), 1) if len(arr) else 1
+        compress = lambda frame: _pack_bits(frame, bits)  # noqa: E731
+    else:
+        raise ValueError(f"Unknown codec {codec!r}, expected one of {list(codecs.values())}.")
+
+    frames = [compress(arr[start : start + frame_size]) for start in range(0, len(arr), frame_size)]
+    offsets = np.cumsum([HDR_V2_SIZE + 8 * (len(frames) + 1)] + [len(frame) for frame in frames], dtype="<u8")
+    f.write(struct.pack("<BBQQ", codec_code(codec), bits, frame_size, len(frames)))
+    f.write(offsets.tobytes())
+    for frame in frames:
+        f.write(frame)
+
+
+class CompressedChunk:
+    """Random access to the tokens of a version 2 chunk."""
+
+    def __init__(self, path):
+        self._mmap = np.memmap(path, dtype=np.uint8, mode="r")
+        magic, version, dtype_code, chunk_size, codec, bits, frame_size, n_frames = struct.unpack(
+            HDR_V2_FORMAT, self._mmap[:HDR_V2_SIZE].tobytes()
+        )
+        assert magic == HDR_MAGIC and version == 2, "File doesn't match expected format."
+        self.dtype = dtypes[dtype_code]
+        self.chunk_size = chunk_size
+        self.codec = codecs[codec]
+        self._bits = bits
+        self._frame_size = frame_size
+        self._offsets = np.frombuffer(self._mmap, dtype="<u8", count=n_frames + 1, offset=HDR_V2_SIZE)
+        self._decompress = None
+        if self.codec == "zstd":
+            import zstandard as zstd
+
+            self._decompress = zstd.ZstdDecompressor().decompress
+
+    def __len__(self):
+        return self.chunk_size
+
+    def _frame(self, frame_idx):
+        buffer = self._mmap[self._offsets[frame_idx] : self._offsets[frame_idx + 1]]
+        count = min(self._frame_size, self.chunk_size - frame_idx * self._frame_size)
+        if self.codec == "zstd":
+            return np.frombuffer(self._decompress(buffer), dtype=self.dtype, count=count)
+        return _unpack_bits(buffer, self._bits, count, self.dtype)
+
+    def read(self, start=0, stop=None):
+        """Return the tokens `start:stop`, decompressing only the frames they fall in."""
+        stop = self.chunk_size if stop is None else min(stop, self.chunk_size)
+        if stop <= start:
+            return np.empty(0, dtype=self.dtype)
+        first, last = start // self._frame_size, (stop - 1) // self._frame_size
+        frames = [self._frame(frame_idx) for frame_idx in range(first, last + 1)]
+        tokens = np.concatenate(frames) if len(frames) > 1 else frames[0]
+        offset = first * self._frame_size
+        return tokens[start - offset : stop - offset]
+
+    def close(self):
+        self._mmap._mmap.close()
+
+
+def open_chunk(path):
+    """Return the tokens of the chunk at `path`, mmapped if it is a version 1 chunk or as a `CompressedChunk`."""
+    with open(path, "rb") as f:
+        (version,) = struct.unpack("<Q", f.read(len(HDR_MAGIC) + 8)[len(HDR_MAGIC) :])
+    if version == 2:
+        return CompressedChunk(path)
+    dtype, chunk_size = read_header(path)
+    return np.memmap(path, dtype=dtype, mode="r", offset=HDR_SIZE, shape=(chunk_size,))
+
+
+def read_chunk(path):
+    """Return all tokens of the chunk at `path`, mmapped if it is a version 1 chunk or decompressed."""
+    chunk = open_chunk(path)
+    if isinstance(chunk, np.memmap):
+        return chunk
+    tokens = chunk.read()
+    chunk.close()
+    return tokens
+
+
+def close_chunk(chunk):
+    if isinstance(chunk, np.memmap):
+        chunk._mmap.close()
+    elif isinstance(chunk, CompressedChunk):
+        chunk.close()
+
+
+def convert_chunk(src, dst, codec="zstd", frame_size=DEFAULT_FRAME_SIZE, level=3):
+    """Rewrite the chunk `src` as a version 2 chunk at `dst`, or as a version 1 chunk if `codec` is None."""
+    tokens = read_chunk(src)
+    tmp_path = dst + ".tmp"
+    with open(tmp_path, "wb") as f:
+        write_chunk(f, np.asarray(tokens), codec=codec, frame_size=frame_size, level=level)
+    os.replace(tmp_path, dst)
+    close_chunk(tokens)
+    return os.path.getsize(src), os.path.getsize(dst)
+
+
+def check_manifest_filename(filename):
+    """Raise if the basename of `filename` does not fit in a manifest entry, which would silently truncate it."""
+    name = os.path.basename(filename).encode()
+    if len(name) > MANIFEST_FILENAME_SIZE:
+        raise ValueError(
+            f"The chunk name {name.decode()!r} is longer than the {MANIFEST_FILENAME_SIZE} bytes of a manifest entry."
+        )
+    return name
+
+
+def load_manifest(data_dir):
+    """Return the manifest of `data_dir` as a structured array, or None if the directory has no manifest."""
+    path = os.path.join(data_dir, MANIFEST_NAME)
+    if not os.path.isfile(path):
+        return None
+    return np.load(path)
+
+
+def select_manifest(manifest, prefix):
+    """Return the manifest entries whose filename starts with `prefix`, checking that their headers agree."""
+    entries = manifest[np.char.startswith(manifest["filename"], prefix.encode())]
+    if len(entries) and (
+        np.any(entries["dtype"] != entries["dtype"][0]) or np.any(entries["chunk_size"] != entries["chunk_size"][0])
+    ):
+        raise ValueError(f"Chunks with prefix {prefix!r} do not share the same dtype and chunk size.")
+    return entries
+
+
+def build_manifest(data_dir, sep_token=None):
+    """Merge the per-builder manifest parts of `data_dir` into its manifest.
+
+    Entries of chunks that were deleted are dropped. Chunks that are neither in an existing manifest nor in a part
+    (e.g. directories prepared before manifests existed) are indexed from their headers. Their token statistics are
+    only computed if `sep_token` is given.
+    """
+    entries = {}
+    manifest = load_manifest(data_dir)
+    if manifest is not None:
+        entries.update((entry["filename"], entry) for entry in manifest)
+    parts = sorted(glob.glob(os.path.join(data_dir, f"*{MANIFEST_PART_SUFFIX}")))
+    for part in parts:
+        entries.update((entry["filename"], entry) for entry in np.load(part))
+    entries = {name: entry for name, entry in entries.items() if os.path.isfile(os.path.join(data_dir, name.decode()))}
+
+    for path in sorted(glob.glob(os.path.join(data_dir, "*.bin"))):
+        name = check_manifest_filename(path)
+        if name in entries:
+            continue
+        dtype, chunk_size = read_header(path)
+        entry = np.zeros((), dtype=MANIFEST_DTYPE)
+        entry["filename"] = name
+        entry["dtype"] = code(dtype)
+        entry["chunk_size"] = chunk_size
+        entry["n_tokens"] = chunk_size
+        if sep_token is not None:
+            arr = read_chunk(path)
+            is_sep = arr == sep_token
+            entry["n_sep"] = np.count_nonzero(is_sep)
+            entry["n_docs"] = np.count_nonzero(is_sep[1:] & ~is_sep[:-1]) + int(not is_sep[0])
+            close_chunk(arr)
+        entries[name] = entry
+
+    manifest = np.array([entries[name] for name in sorted(entries)], dtype=MANIFEST_DTYPE)
+    path = os.path.join(data_dir, MANIFEST_NAME)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        np.save(f, manifest)
+    os.replace(tmp_path, path)
+    for part in parts:
+        os.remove(part)
+    return manifest
+
 
 class PackedDataset(IterableDataset):
     def __init__(
-        self, filenames, n_chunks, block_size, seed=12345, shuffle=True, wrap=False, num_processes=1, process_rank=0
+        self,
+        filenames,
+        n_chunks,
+        block_size,
+        seed=12345,
+        shuffle=True,
+        wrap=False,
+        num_processes=1,
+        process_rank=0,
+        dtype=None,
+        chunk_size=None,
+        prefetch=False,
+        prefetch_bytes=1 << 28,
+        chunk_cache=None,
     ):
+        # `dtype` and `chunk_size` come from the manifest. If they are not given, they are read from the chunk headers
+        # `prefetch` opens the next window of `n_chunks` files in a background thread and warms up to `prefetch_bytes`
+        # of it while the current window is consumed
+        # with a `ChunkCache`, the `filenames` are names on its remote storage and are fetched when a window is opened,
+        # ahead of time if `prefetch`
         self._filenames = filenames
         self._n_chunks = n_chunks
         self._block_size = block_size
@@ -36,16 +331,28 @@ class PackedDataset(IterableDataset):
         self._wrap = wrap
         self._num_processes = num_processes
         self._process_rank = process_rank
+        self._dtype = dtype
+        self._chunk_size = chunk_size
+        self._prefetch = prefetch
+        self._prefetch_bytes = prefetch_bytes
+        self._chunk_cache = chunk_cache
 
     def __iter__(self):
         worker_info = get_worker_info()
         num_workers = worker_info.num_workers if worker_info is not None else 1
         worker_id = worker_info.id if worker_info is not None else 0
+        return self._iterator(worker_id, num_workers)
+
+    def _iterator(self, worker_id, num_workers):
         num_shards = num_workers * self._num_processes
         shard_id = self._process_rank * num_workers + worker_id
 
-        max_num_files = len(self._filenames) // num_shards * num_shards
-        filenames = self._filenames[shard_id:max_num_files:num_shards]
+        # the files that don't divide evenly go to the first shards, so that every file is read
+        filenames = self._filenames[shard_id::num_shards]
+        if not filenames:
+            raise ValueError(
+                f"{len(self._filenames)} files can't be split into {num_shards} shards (processes x workers)."
+            )
 
         return PackedDatasetIterator(
             filenames=filenames,
@@ -54,21 +361,43 @@ class PackedDataset(IterableDataset):
             seed=self._seed,
             shuffle=self._shuffle,
             wrap=self._wrap,
+            dtype=self._dtype,
+            chunk_size=self._chunk_size,
+            prefetch=self._prefetch,
+            prefetch_bytes=self._prefetch_bytes,
+            chunk_cache=self._chunk_cache,
         )
 
 
+def auto_dtype(vocab_size):
+    """The smallest dtype the builder stores the tokens of a `vocab_size` vocabulary in."""
+    return np.uint16 if vocab_size < 65500 else np.int32
+
+
 class PackedDatasetBuilder(object):
-    def __init__(self, outdir, prefix, chunk_size, sep_token, dtype="auto", vocab_size=None):
+    def __init__(
+        self,
+        outdir,
+        prefix,
+        chunk_size,
+        sep_token,
+        dtype="auto",
+        vocab_size=None,
+        codec=None,
+        frame_size=None,
+        num_buffers=1,
+        fsync=False,
+        counter=0,
+    ):
         if dtype == "auto":
             if vocab_size is None:
                 raise ValueError("vocab_size cannot be None when dtype='auto'")
-            if vocab_size is not None and vocab_size < 65500:
-                self._dtype = np.uint16
-            else:
-                self._dtype = np.int32
+            self._dtype = auto_dtype(vocab_size)
         else:
             self._dtype = dtype
-        self._counter = 0
+        check_manifest_filename(f"{prefix}_{counter:010d}.bin")
+        # the number in the name of the next chunk, to add chunks to an existing series
+        self._counter = counter
         self._chunk_size = chunk_size
         self._outdir = outdir
         self._prefix = prefix
@@ -76,24 +405,82 @@ class PackedDatasetBuilder(object):
         self._arr = np.zeros(self._chunk_size, dtype=self._dtype)
         self._arr.fill(self._sep_token)
         self._idx = 0
-        self._version = 1
+        # version 2 chunks are compressed with `codec` in frames of `frame_size` tokens
+        self._codec = codec
+        self._frame_size = frame_size or DEFAULT_FRAME_SIZE
         self._filenames = []
+        self._n_docs = 0
+        self._doc_starts = []
+        self._doc_sources = []
+        self._carry_source = 0  # source id of the document the next chunk may start with
+        self._manifest = []
+        # with more than one buffer, full chunks are written by a thread while the next buffer is filled
+        self._num_buffers = num_buffers
+        self._n_buffers = 1
+        self._fsync = fsync
+        self._executor = ThreadPoolExecutor(max_workers=1) if num_buffers > 1 else None
+        self._pending = deque()  # (future, buffer) of the chunks being written, oldest first
 
     def _write_chunk(self):
         filename = f"{self._prefix}_{self._counter:010d}.bin"
         filename = os.path.join(self._outdir, filename)
-
-        with open(filename, "wb") as f:
-            f.write(HDR_MAGIC)
-            f.write(struct.pack("<Q", self._version))
-            f.write(struct.pack("<B", code(self._dtype)))
-            f.write(struct.pack("<Q", self._chunk_size))
-            f.write(self._arr.tobytes(order="C"))
+        args = (filename, self._arr, self._idx, self._n_docs, self._doc_starts, self._doc_sources)
+        if self._executor is None:
+            self._manifest.append(self._write_buffer(*args))
+        else:
+            self._pending.append((self._executor.submit(self._write_buffer, *args), self._arr))
+            self._arr = self._next_buffer()
 
         self._filenames.append(filename)
         self._counter += 1
-        self._arr.fill(self._sep_token)
+        if self._doc_sources:
+            self._carry_source = self._doc_sources[-1]
         self._idx = 0
+        self._n_docs = 0
+        self._doc_starts = []
+        self._doc_sources = []
+
+    def _write_buffer(self, filename, arr, n_tokens, n_docs, doc_starts, doc_sources):
+        # written under a temporary name, so a chunk only appears in `outdir` once it is complete
+        tmp_filename = filename + ".tmp"
+        with open(tmp_filename, "wb") as f:
+            write_chunk(f, arr, codec=self._codec, frame_size=self._frame_size)
+            if self._fsync:
+                f.flush()
+                os.fsync(f.fileno())
+        write_doc_index(filename, doc_starts, doc_sources)
+        os.replace(tmp_filename, filename)
+
+        entry = (
+            os.path.basename(filename),
+            code(self._dtype),
+            self._chunk_size,
+            n_tokens,
+            n_docs,
+            np.count_nonzero(arr == self._sep_token),
+        )
+        arr.fill(self._sep_token)
+        return entry
+
+    def _next_buffer(self):
+        if self._n_buffers < self._num_buffers:
+            self._n_buffers += 1
+            return np.full(self._chunk_size, self._sep_token, dtype=self._dtype)
+        future, arr = self._pending.popleft()
+        self._manifest.append(future.result())
+        return arr
+
+    def flush(self):
+        """Wait until the chunks handed to the writer thread are written."""
+        while self._pending:
+            future, _ = self._pending.popleft()
+            self._manifest.append(future.result())
+
+    def close(self):
+        self.flush()
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
 
     @property
     def dtype(self):
@@ -101,12 +488,28 @@ class PackedDatasetBuilder(object):
 
     @property
     def filenames(self):
+        self.flush()
         return self._filenames.copy()
 
-    def add_array(self, arr):
+    @property
+    def manifest(self):
+        self.flush()
+        return np.array(self._manifest, dtype=MANIFEST_DTYPE)
+
+    def add_array(self, arr, source_id=0, continues=False):
+        """Add the document `arr`, or with `continues`, the rest of the last document, whose source is `source_id`."""
+        if self._idx == self._chunk_size:
+            self._write_chunk()
+        if not continues:
+            self._n_docs += 1
+            self._doc_starts.append(self._idx)
+            self._doc_sources.append(source_id)
+        elif not self._doc_starts:
+            self._carry_source = source_id
         while self._idx + arr.shape[0] > self._chunk_size:
             part_len = self._chunk_size - self._idx
             self._arr[self._idx : self._idx + part_len] = arr[:part_len]
+            self._idx += part_len
             self._write_chunk()
             arr = arr[part_len:]
 
@@ -114,12 +517,51 @@ class PackedDatasetBuilder(object):
         self._arr[self._idx : self._idx + arr_len] = arr
         self._idx += arr_len
 
+    @property
+    def continues(self):
+        """Whether the tokens added since the last chunk was written start with the rest of a document."""
+        return self._idx > 0 and (not self._doc_starts or self._doc_starts[0] > 0)
+
+    def remainder(self):
+        """Return the tokens added since the last chunk was written and the start offsets and source ids of their
+        documents, the first of which may continue a document of the last chunk."""
+        doc_starts, doc_sources = list(self._doc_starts), list(self._doc_sources)
+        if self._idx and (not doc_starts or doc_starts[0] > 0):
+            doc_starts.insert(0, 0)
+            doc_sources.insert(0, self._carry_source)
+        return self._arr[: self._idx].copy(), doc_starts, doc_sources
+
     def write_reminder(self):
         self._write_chunk()
+        self.flush()
+
+    def write_manifest(self):
+        """Write the manifest entries of the chunks written so far. Merge them with `build_manifest`."""
+        path = os.path.join(self._outdir, f"{self._prefix}{MANIFEST_PART_SUFFIX}")
+        np.save(path, self.manifest)
+
+
+def _close_window(future):
+    if not future.cancelled() and future.exception() is None:
+        for mmap in future.result():
+            close_chunk(mmap)
 
 
 class PackedDatasetIterator:
-    def __init__(self, filenames, n_chunks, block_size, seed, shuffle, wrap):
+    def __init__(
+        self,
+        filenames,
+        n_chunks,
+        block_size,
+        seed,
+        shuffle,
+        wrap,
+        dtype=None,
+        chunk_size=None,
+        prefetch=False,
+        prefetch_bytes=1 << 28,
+        chunk_cache=None,
+    ):
         self._seed = seed
         self._shuffle = shuffle
         self._rng = np.random.default_rng(seed) if shuffle else None
@@ -135,62 +577,148 @@ class PackedDatasetIterator:
 
         self._n_chunks = n_chunks
 
-        self._dtype = None
+        self._dtype = dtype
+        self._chunk_size = chunk_size
         self._block_size = block_size
-        self._n_blocks = None
+        self._n_blocks = chunk_size // block_size if chunk_size is not None else None
+        # headers are only read (and checked against each other) when the manifest did not provide them
+        self._check_headers = dtype is None
 
         self._mmaps = []
         self._buffers = []
+        self._blocks = []
+
+        self._prefetch_bytes = prefetch_bytes
+        self._chunk_cache = chunk_cache
+        self._executor = ThreadPoolExecutor(max_workers=1) if prefetch else None
+        self._prefetched = None  # (file_idx, future) of the window opened in the background
 
         self._block_idxs = []
         self._curr_idx = 0
 
         self._load_n_chunks()
 
+    def _open_file(self, filename, opener):
+        return self._chunk_cache.open(filename, opener) if self._chunk_cache is not None else opener(filename)
+
     def _read_header(self, path):
-        with open(path, "rb") as f:
-            magic = f.read(len(HDR_MAGIC))
-            assert magic == HDR_MAGIC, "File doesn't match expected format."
-            version = struct.unpack("<Q", f.read(8))
-            assert version == (1,)
-            (dtype_code,) = struct.unpack("<B", f.read(1))
-            dtype = dtypes[dtype_code]
-            (chunk_size,) = struct.unpack("<Q", f.read(8))
-        return dtype, chunk_size
+        return self._open_file(path, read_header)
 
     def _close_mmaps(self):
         for mmap in self._mmaps:
-            mmap._mmap.close()
+            close_chunk(mmap)
 
     def _load_n_chunks(self):
+        # the window is only mmapped once a block is read from it, so that skipping over windows reads no data
         self._close_mmaps()
         self._mmaps = []
         self._buffers = []
+        self._blocks = []
 
-        if self._n_chunks > len(self._filenames[self._file_idx :]):
+        if self._file_idx >= len(self._filenames):
             # if not self._wrap:
             #     raise StopIteration
             self._file_idx = 0
 
-        for i in range(self._n_chunks):
-            filename = self._filenames[self._file_idx + i]
-            if self._dtype is None:
-                self._dtype, self._chunk_size = self._read_header(filename)
-                self._n_blocks = self._chunk_size // self._block_size
-            # TODO: check header matches with previous files
-            mmap = np.memmap(filename, mode="r", order="C", offset=HDR_SIZE)
-            self._mmaps.append(mmap)
-            self._buffers.append(memoryview(mmap))
+        if self._dtype is None:
+            self._dtype, self._chunk_size = self._read_header(self._filenames[self._file_idx])
+            self._n_blocks = self._chunk_size // self._block_size
+
+        # remember where this window starts so that `state_dict` can rebuild it
+        self._window_file_idx = self._file_idx
+        self._window_rng_state = self._rng.bit_generator.state if self._shuffle else None
 
-        self._file_idx += self._n_chunks
-        n_all_blocks = self._n_chunks * self._n_blocks
+        # the last window of the shard holds the files that are left, which can be fewer than `n_chunks`
+        n_chunks = min(self._n_chunks, len(self._filenames) - self._file_idx)
+        self._file_idx += n_chunks
+        n_all_blocks = n_chunks * self._n_blocks
 
         self._block_idxs = self._rng.permutation(n_all_blocks) if self._shuffle else range(n_all_blocks)
 
         self._curr_idx = 0
 
+    def _open_mmaps(self):
+        if self._prefetched is not None and self._prefetched[0] == self._window_file_idx:
+            self._mmaps = self._prefetched[1].result()
+            self._prefetched = None
+        else:
+            self._drop_prefetched()
+            self._mmaps = self._open_window(self._window_file_idx, warm_bytes=0)
+        self._buffers = [memoryview(mmap) for mmap in self._mmaps]
+        # (n_blocks, block_size) views of the chunks to gather blocks with a single fancy-index read
+        self._blocks = [
+            np.frombuffer(buffer, dtype=self._dtype, count=self._n_blocks * self._block_size).reshape(
+                self._n_blocks, self._block_size
+            )
+            for buffer in self._buffers
+        ]
+
+        if self._executor is not None:
+            file_idx = self._file_idx if self._file_idx < len(self._filenames) else 0
+            self._prefetched = (file_idx, self._executor.submit(self._open_window, file_idx, self._prefetch_bytes))
+
+    def _open_window(self, file_idx, warm_bytes):
+        mmaps = []
+        for filename in self._filenames[file_idx : file_idx + self._n_chunks]:
+            if self._check_headers and self._read_header(filename) != (self._dtype, self._chunk_size):
+                raise ValueError(f"The header of {filename} does not match the header of the previous chunks.")
+            # version 2 chunks are decompressed here, in the background thread when prefetching
+            mmaps.append(self._open_file(filename, read_chunk))
+        if warm_bytes > 0:
+            for mmap in mmaps:
+                self._warm(mmap, warm_bytes // len(mmaps))
+        return mmaps
+
+    def _warm(self, mmap, n_bytes):
+        if not isinstance(mmap, np.memmap):
+            return  # decompressed
+        n_bytes = min(n_bytes, mmap.nbytes)
+        if MADV_WILLNEED is not None:
+            # `mmap._mmap` maps the whole file, including the header
+            mmap._mmap.madvise(MADV_WILLNEED, 0, min(HDR_SIZE + n_bytes, len(mmap._mmap)))
+        else:
+            # read one element per page
+            mmap[: n_bytes // mmap.itemsize : max(4096 // mmap.itemsize, 1)].sum()
+
+    def _drop_prefetched(self):
+        if self._prefetched is not None:
+            for mmap in self._prefetched[1].result():
+                close_chunk(mmap)
+            self._prefetched = None
+
+    def state_dict(self):
+        return {
+            "file_idx": self._window_file_idx,
+            "rng": self._window_rng_state,
+            "curr_idx": self._curr_idx,
+        }
+
+    def load_state_dict(self, state):
+        self._file_idx = state["file_idx"]
+        if self._shuffle:
+            self._rng.bit_generator.state = state["rng"]
+        self._load_n_chunks()
+        self._curr_idx = state["curr_idx"]
+
+    def skip(self, n):
+        """Advance by `n` blocks without reading them."""
+        while n > 0:
+            if self._curr_idx >= len(self._block_idxs):
+                self._load_n_chunks()
+            step = min(n, len(self._block_idxs) - self._curr_idx)
+            self._curr_idx += step
+            n -= step
+
     def __del__(self):
         self._close_mmaps()
+        if self._executor is not None:
+            # never block the garbage collector on the prefetch thread: a window it is still opening is closed once it
+            # is done. The last reference may also be dropped by the prefetch thread itself, which can't be joined
+            if self._prefetched is not None and not self._prefetched[1].cancel():
+                self._prefetched[1].add_done_callback(_close_window)
+            self._prefetched = None
+            self._executor.shutdown(wait=False, cancel_futures=True)
+        del self._blocks
         del self._mmaps
         del self._buffers
 
@@ -200,7 +728,8 @@ class PackedDatasetIterator:
     def __next__(self):
         if self._curr_idx >= len(self._block_idxs):
             self._load_n_chunks()
-            # TODO: trigger fetching next next n_chunks if remote
+        if not self._buffers:
+            self._open_mmaps()
         block_idx = self._block_idxs[self._curr_idx]
         chunk_id = block_idx // self._n_blocks
         buffer = self._buffers[chunk_id]
@@ -210,26 +739,481 @@ class PackedDatasetIterator:
         self._curr_idx += 1
         return torch.from_numpy(arr.astype(np.int64))
 
+    @property
+    def dtype(self):
+        return self._dtype
+
+    @property
+    def block_size(self):
+        return self._block_size
+
+    def read_blocks(self, out, rows):
+        """Read the next `len(rows)` blocks into `out[rows]`, converting them to the dtype of `out`."""
+        i = 0
+        while i < len(rows):
+            if self._curr_idx >= len(self._block_idxs):
+                self._load_n_chunks()
+            if not self._buffers:
+                self._open_mmaps()
+            n = min(len(rows) - i, len(self._block_idxs) - self._curr_idx)
+            block_idxs = np.asarray(self._block_idxs[self._curr_idx : self._curr_idx + n])
+            chunk_ids, block_rows = np.divmod(block_idxs, self._n_blocks)
+            out_rows = rows[i : i + n]
+            for chunk_id in np.unique(chunk_ids):
+                sel = chunk_ids == chunk_id
+                out[out_rows[sel]] = self._blocks[chunk_id][block_rows[sel]]
+            self._curr_idx += n
+            i += n
+
 
 class CombinedDataset(IterableDataset):
-    def __init__(self, datasets, seed, weights=None):
+    def __init__(self, datasets, seed, weights=None, batch_size=None, pin_memory=False, mixture="stratified"):
+        # with `batch_size`, whole batches are gathered in the dataset, so the DataLoader must use `batch_size=None`.
+        # Batches keep the token dtype of the chunks (see `to_token_ids`). See `MixtureSchedule` for `mixture`
         self._seed = seed
         self._datasets = datasets
         self._weights = weights
         n_datasets = len(datasets)
         if weights is None:
             self._weights = [1 / n_datasets] * n_datasets
+        self._batch_size = batch_size
+        self._pin_memory = pin_memory
+        self._mixture = mixture
+        self._state = None
+        self._last_state = None
 
     def __iter__(self):
-        return CombinedDatasetIterator(self._datasets, self._seed, self._weights)
+        worker_info = get_worker_info()
+        num_workers = worker_info.num_workers if worker_info is not None else 1
+        worker_id = worker_info.id if worker_info is not None else 0
+        return self._iterator(worker_id, num_workers)
+
+    def _iterator(self, worker_id, num_workers):
+        if self._state is None:
+            return self._worker_iterator(worker_id, num_workers)
+        self._check_num_workers(num_workers)
+        # the DataLoader always starts with its first worker, so the workers take over the state of the worker whose
+        # turn it was when the state was saved
+        worker_id = (worker_id + self._state["worker_offset"]) % num_workers
+        return self._worker_iterator(worker_id, num_workers, self._state["worker_states"][worker_id])
+
+    def _worker_iterator(self, worker_id, num_workers, state=None):
+        iterator = CombinedDatasetIterator(
+            [dataset._iterator(worker_id, num_workers) for dataset in self._datasets],
+            self._seed,
+            self._weights,
+            batch_size=self._batch_size,
+            pin_memory=self._pin_memory,
+            mixture=self._mixture,
+        )
+        if state is not None:
+            iterator.load_state_dict(state)
+        return iterator
+
+    def _check_num_workers(self, num_workers):
+        if self._state["num_workers"] != num_workers:
+            raise ValueError(
+                f"The data state was saved with {self._state['num_workers']} workers, but {num_workers} are used."
+            )
+
+    def state_dict(self, num_batches, batch_size, num_workers=0):
+        """Return the state of the iterators after the DataLoader yielded `num_batches` batches since the state was
+        last loaded.
+
+        The state is computed by skipping over the consumed samples instead of being read from the live iterators, so
+        that it is also available in the main process when the iterators run in DataLoader workers, which yield whole
+        batches in turn. Only the samples consumed since the previous call are skipped.
+        """
+        num_workers = max(num_workers, 1)
+        offset = 0
+        if self._state is not None:
+            self._check_num_workers(num_workers)
+            offset = self._state["worker_offset"]
+        if self._last_state is not None and self._last_state[0] <= num_batches:
+            done, state = self._last_state
+        else:
+            done, state = 0, self._state
+        worker_states = []
+        for worker_id in range(num_workers):
+            iterator = self._worker_iterator(
+                worker_id, num_workers, state["worker_states"][worker_id] if state is not None else None
+            )
+            loader_worker_id = (worker_id - offset) % num_workers
+            n_batches = _worker_batches(num_batches, loader_worker_id, num_workers) - _worker_batches(
+                done, loader_worker_id, num_workers
+            )
+            iterator.skip(n_batches * batch_size)
+            worker_states.append(iterator.state_dict())
+        state = {
+            "num_workers": num_workers,
+            "worker_offset": (offset + num_batches) % num_workers,
+            "worker_states": worker_states,
+        }
+        self._last_state = (num_batches, state)
+        return state
+
+    def token_counts(self, num_batches, batch_size, num_workers=0):
+        """Return the number of tokens read from each dataset over all workers, once the DataLoader yielded
+        `num_batches` batches since the state was last loaded."""
+        state = self.state_dict(num_batches, batch_size, num_workers)
+        return np.sum([worker_state["token_counts"] for worker_state in state["worker_states"]], axis=0)
+
+    def load_state_dict(self, state):
+        """Resume the iterators created from now on (also in DataLoader workers) from `state`."""
+        self._state = state
+        self._last_state = None
+
+
+def _torch_dtype(dtype):
+    # uint16 tokens are shipped as their int16 bit pattern and widened on the device by `to_token_ids`
+    if dtype == np.uint16:
+        return torch.int16
+    return torch.from_numpy(np.empty(0, dtype=dtype)).dtype
+
+
+def to_token_ids(batch, dtype=torch.int64):
+    """Widen a batch gathered by `CombinedDataset(batch_size=...)` to token ids, on the device it was moved to."""
+    if batch.dtype == torch.int16:
+        return batch.to(dtype) & 0xFFFF
+    return batch.to(dtype)
+
+
+def split_blocks(batch, seq_len):
+    """Split a batch of blocks of `block_size + 1` tokens into rows of `seq_len + 1` tokens.
+
+    Consecutive rows of a block overlap by one token, the target of the last position of a row and the input of the
+    first position of the next, so a batch keeps its number of trained tokens if `seq_len` divides `block_size`.
+    """
+    block_size = batch.size(1) - 1
+    if seq_len >= block_size:
+        return batch
+    n_rows = block_size // seq_len
+    return batch[:, : n_rows * seq_len + 1].unfold(1, seq_len + 1, seq_len).reshape(-1, seq_len + 1)
+
+
+class SeqLenSchedule:
+    """Sequence length warmup over the same blocks of `block_size + 1` tokens.
+
+    The sequence length grows linearly from `min_seq_len` to `block_size` over `warmup_steps` steps, rounded down to
+    a divisor of `block_size`, and the blocks are split into rows of that length with `split_blocks`. A step thus
+    trains on the same tokens at every length, only with a shorter context early on.
+    """
+
+    def __init__(self, block_size, min_seq_len, warmup_steps):
+        if not 0 < min_seq_len <= block_size:
+            raise ValueError(f"min_seq_len must be in [1, {block_size}], got {min_seq_len}.")
+        self._block_size = block_size
+        self._min_seq_len = min_seq_len
+        self._warmup_steps = warmup_steps
+        self._seq_lens = [n for n in range(min_seq_len, block_size + 1) if block_size % n == 0]
+
+    def __call__(self, step):
+        if step >= self._warmup_steps:
+            return self._block_size
+        target = self._min_seq_len + (self._block_size - self._min_seq_len) * step / self._warmup_steps
+        return self._seq_lens[max(bisect.bisect_right(self._seq_lens, target) - 1, 0)]
+
+
+def _worker_batches(num_batches, worker_id, num_workers):
+    return num_batches // num_workers + int(worker_id < num_batches % num_workers)
+
+
+class MixtureSchedule:
+    """Assigns one of the weighted sources to every sample position.
+
+    In "stratified" mode, the sources are interleaved deterministically: the `j`-th sample of source `i` is placed at
+    `(j + 0.5) / weight_i`, so that every prefix of the schedule, however short, takes each source within about one
+    sample of its weight. In "random" mode, the sources are drawn independently, in windows of `window_size` samples
+    that only depend on the seed and their index. Either way the schedule can be resumed from any position.
+    """
+
+    def __init__(self, weights, seed, mode="stratified", window_size=4096):
+        if mode not in ("stratified", "random"):
+            raise ValueError(f"Unknown mixture mode: {mode!r}")
+        weights = np.asarray(weights, dtype=np.float64)
+        self._weights = weights / weights.sum()
+        self._cum_weights = np.cumsum(self._weights)
+        self._cum_weights[-1] = 1.0
+        self._n_sources = len(weights)
+        self._seed = seed
+        self._mode = mode
+        self._window_size = window_size
+        self._window_idx = None
+        self._window = None
+
+    def _prefix_counts(self, n):
+        # the samples of each source among the first `n` of the stratified schedule, ordered by their place and then
+        # by source: all the samples placed up to `n`, less the last or plus the next ones to make `n` of them
+        counts = np.floor(self._weights * n + 0.5).astype(np.int64)
+        with np.errstate(divide="ignore"):
+            while counts.sum() > n:
+                last = np.where(counts > 0, (counts - 0.5) / self._weights, -np.inf)
+                counts[self._n_sources - 1 - np.argmax(last[::-1])] -= 1
+            while counts.sum() < n:
+                counts[np.argmin((counts + 0.5) / self._weights)] += 1
+        return counts
+
+    def _sources_of_window(self, window_idx):
+        if window_idx != self._window_idx:
+            if self._mode == "stratified":
+                start = window_idx * self._window_size
+                first = self._prefix_counts(start)
+                n = self._prefix_counts(start + self._window_size) - first
+                sources = np.repeat(np.arange(self._n_sources), n)
+                # the index of each sample within its source
+                samples = np.arange(len(sources)) - np.repeat(np.cumsum(n) - n - first, n)
+                places = (samples + 0.5) / self._weights[sources]
+                self._window = sources[np.lexsort((sources, places))]
+            else:
+                rng = np.random.default_rng([self._seed, window_idx])
+                self._window = np.searchsorted(self._cum_weights, rng.random(self._window_size), side="right")
+            self._window_idx = window_idx
+        return self._window
+
+    def sources(self, start, n):
+        """Return the sources of the positions `start` to `start + n`."""
+        out = np.empty(n, dtype=np.intp)
+        i = 0
+        while i < n:
+            window_idx, offset = divmod(start + i, self._window_size)
+            k = min(n - i, self._window_size - offset)
+            out[i : i + k] = self._sources_of_window(window_idx)[offset : offset + k]
+            i += k
+        return out
+
+    def counts(self, start, n):
+        """Return how many of the positions `start` to `start + n` each source gets."""
+        if self._mode == "stratified":
+            return self._prefix_counts(start + n) - self._prefix_counts(start)
+        counts = np.zeros(self._n_sources, dtype=np.int64)
+        i = 0
+        while i < n:
+            k = min(n - i, self._window_size - (start + i) % self._window_size)
+            counts += np.bincount(self.sources(start + i, k), minlength=self._n_sources)
+            i += k
+        return counts
 
 
 class CombinedDatasetIterator:
-    def __init__(self, datasets, seed, weights):
+    def __init__(self, datasets, seed, weights, batch_size=None, pin_memory=False, mixture="stratified"):
         self._datasets = [iter(el) for el in datasets]
-        self._weights = weights
-        self._rng = random.Random(seed)
+        self._schedule = MixtureSchedule(weights, seed, mode=mixture)
+        self._position = 0
+        self._token_counts = np.zeros(len(self._datasets), dtype=np.int64)
+        self._batch_size = batch_size
+        # batches are only pinned outside of DataLoader workers, which must not initialize CUDA
+        self._pin_memory = pin_memory and torch.cuda.is_available() and get_worker_info() is None
+
+    @property
+    def token_counts(self):
+        """Number of tokens read from each source so far."""
+        return self._token_counts.copy()
+
+    def _block_sizes(self):
+        return np.array([dataset.block_size for dataset in self._datasets], dtype=np.int64)
 
     def __next__(self):
-        (dataset,) = self._rng.choices(self._datasets, weights=self._weights, k=1)
+        if self._batch_size is not None:
+            return self._next_batch()
+        source = int(self._schedule.sources(self._position, 1)[0])
+        self._position += 1
+        dataset = self._datasets[source]
+        self._token_counts[source] += dataset.block_size
         return next(dataset)
+
+    def _next_batch(self):
+        sources = self._schedule.sources(self._position, self._batch_size)
+        self._position += self._batch_size
+        self._token_counts += np.bincount(sources, minlength=len(self._datasets)) * self._block_sizes()
+        dtype = reduce(np.promote_types, [dataset.dtype for dataset in self._datasets])
+        batch = self._empty_batch(dtype)
+        out = batch.numpy().view(dtype)
+        for i, dataset in enumerate(self._datasets):
+            rows = np.flatnonzero(sources == i)
+            if len(rows):
+                dataset.read_blocks(out, rows)
+        return batch
+
+    def _empty_batch(self, dtype):
+        # a new pinned batch every time: the caching host allocator only hands a freed pinned block out again once
+        # the non-blocking copies recorded on it are done, so a batch is never overwritten while it is being copied
+        return torch.empty(
+            (self._batch_size, self._datasets[0].block_size), dtype=_torch_dtype(dtype), pin_memory=self._pin_memory
+        )
+
+    def state_dict(self):
+        return {
+            "position": self._position,
+            "token_counts": self._token_counts.tolist(),
+            "datasets": [dataset.state_dict() for dataset in self._datasets],
+        }
+
+    def load_state_dict(self, state):
+        self._position = state["position"]
+        self._token_counts = np.array(state["token_counts"], dtype=np.int64)
+        for dataset, dataset_state in zip(self._datasets, state["datasets"]):
+            dataset.load_state_dict(dataset_state)
+
+    def skip(self, n):
+        """Advance by `n` samples without reading them."""
+        counts = self._schedule.counts(self._position, n)
+        self._position += n
+        self._token_counts += counts * self._block_sizes()
+        for dataset, count in zip(self._datasets, counts):
+            dataset.skip(int(count))
+
+
+class PackedBlockDataset(Dataset):
+    """Random access to every block of every chunk in `filenames`.
+
+    Block `i` is located from the number of blocks of each chunk, in O(1) if all chunks have the same size. The
+    chunks are mmapped on first access and at most `max_open_files` of them are kept open per process.
+    """
+
+    def __init__(self, filenames, block_size, dtype=None, chunk_sizes=None, max_open_files=128):
+        # `dtype` and `chunk_sizes` come from the manifest. If they are not given, they are read from the chunk headers
+        if dtype is None or chunk_sizes is None:
+            headers = [read_header(filename) for filename in filenames]
+            if any(header_dtype != headers[0][0] for header_dtype, _ in headers):
+                raise ValueError("The chunks do not share the same dtype.")
+            dtype = headers[0][0]
+            chunk_sizes = [chunk_size for _, chunk_size in headers]
+        self._filenames = filenames
+        self._block_size = block_size
+        self._dtype = dtype
+        self._n_blocks = np.asarray(chunk_sizes, dtype=np.int64) // block_size
+        self._uniform = bool(np.all(self._n_blocks == self._n_blocks[0]))
+        self._first_blocks = np.concatenate([[0], np.cumsum(self._n_blocks)])
+        self._max_open_files = max_open_files
+        self._mmaps = OrderedDict()
+
+    def __len__(self):
+        return int(self._first_blocks[-1])
+
+    def locate(self, idx):
+        """Return the chunk and the row in the chunk of the blocks `idx`."""
+        idx = np.asarray(idx, dtype=np.int64)
+        if self._uniform:
+            return np.divmod(idx, self._n_blocks[0])
+        file_idx = np.searchsorted(self._first_blocks, idx, side="right") - 1
+        return file_idx, idx - self._first_blocks[file_idx]
+
+    def _chunk(self, file_idx):
+        if file_idx in self._mmaps:
+            self._mmaps.move_to_end(file_idx)
+            return self._mmaps[file_idx]
+        if len(self._mmaps) >= self._max_open_files:
+            _, chunk = self._mmaps.popitem(last=False)
+            close_chunk(chunk)
+        chunk = open_chunk(self._filenames[file_idx])
+        self._mmaps[file_idx] = chunk
+        return chunk
+
+    def __getitem__(self, idx):
+        file_idx, row = self.locate(idx)
+        chunk = self._chunk(int(file_idx))
+        start = int(row) * self._block_size
+        if isinstance(chunk, CompressedChunk):
+            # only the frames the block falls in are decompressed
+            arr = np.array(chunk.read(start, start + self._block_size))
+        else:
+            arr = np.array(chunk[start : start + self._block_size])
+        # keep the token dtype, see `to_token_ids`
+        return torch.from_numpy(arr.view(np.int16) if arr.dtype == np.uint16 else arr)
+
+    def __getstate__(self):
+        # the open chunks are not shared with DataLoader workers
+        state = self.__dict__.copy()
+        state["_mmaps"] = OrderedDict()
+        return state
+
+
+class FeistelPermutation:
+    """A pseudo-random permutation of `range(n)` evaluated on the fly, without materializing it.
+
+    A balanced Feistel network permutes the smallest even power of two that covers `n` and indices that fall outside
+    of `range(n)` are encrypted again (cycle walking), fewer than four times on average.
+    """
+
+    def __init__(self, n, seed, rounds=4):
+        bits = max((n - 1).bit_length(), 2)
+        bits += bits % 2
+        self._n = n
+        self._half_bits = np.uint64(bits // 2)
+        self._mask = np.uint64((1 << (bits // 2)) - 1)
+        self._keys = np.random.default_rng(seed).integers(0, np.iinfo(np.int64).max, size=rounds, dtype=np.uint64)
+
+    @staticmethod
+    def _mix(x, key):
+        # splitmix64 finalizer
+        x = x ^ key
+        x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+        x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+        return x ^ (x >> np.uint64(31))
+
+    def _encrypt(self, x):
+        left, right = x >> self._half_bits, x & self._mask
+        for key in self._keys:
+            left, right = right, left ^ (self._mix(right, key) & self._mask)
+        return (left << self._half_bits) | right
+
+    def __call__(self, idx):
+        x = self._encrypt(np.asarray(idx, dtype=np.uint64))
+        outside = x >= self._n
+        while outside.any():
+            x[outside] = self._encrypt(x[outside])
+            outside = x >= self._n
+        return x.astype(np.int64)
+
+
+class GlobalShuffleSampler(Sampler):
+    """Yields the indices of a `PackedBlockDataset` in a global random order that is reshuffled every epoch.
+
+    The epochs are treated as one stream whose positions are dealt to the processes in turn, so every process gets the
+    same number of samples and no block is dropped or repeated within an epoch. DataLoader workers split the indices
+    of their process among themselves. Unless `infinite`, iteration stops after the first epoch.
+    """
+
+    def __init__(self, n, seed, shuffle=True, num_processes=1, process_rank=0, infinite=True):
+        self._n = n
+        self._seed = seed
+        self._shuffle = shuffle
+        self._num_processes = num_processes
+        self._process_rank = process_rank
+        self._infinite = infinite
+        self._position = 0  # samples of this process to start from
+        self._epoch = None
+        self._permutation = None
+
+    def __len__(self):
+        if self._infinite:
+            raise TypeError("An infinite sampler has no length.")
+        return len(range(self._process_rank, self._n, self._num_processes))
+
+    def _permute(self, epoch, idx):
+        if not self._shuffle:
+            return idx
+        if epoch != self._epoch:
+            self._permutation = FeistelPermutation(self._n, [self._seed, epoch])
+            self._epoch = epoch
+        return self._permutation(idx)
+
+    def __iter__(self):
+        position = self._position
+        while True:
+            positions = (position + np.arange(4096, dtype=np.int64)) * self._num_processes + self._process_rank
+            if not self._infinite:
+                positions = positions[positions < self._n]
+                if not len(positions):
+                    return
+            epochs, idx = np.divmod(positions, self._n)
+            for epoch in np.unique(epochs):
+                yield from self._permute(int(epoch), idx[epochs == epoch]).tolist()
+            position += len(positions)
+
+    def state_dict(self, num_batches, batch_size, num_workers=0):
+        """Return the position after the DataLoader yielded `num_batches` batches since the state was last loaded."""
+        return {"position": self._position + num_batches * batch_size}
+
+    def load_state_dict(self, state):
+        self._position = state["position"]
@@ -0,0 +1,558 @@
+"""Streaming, resumable pipeline that tokenizes text sources into packed chunks.
+
+The stages run in separate processes connected by bounded queues:
+
+    read (decompress, batch raw records) -> tokenize (parse, filter, encode) -> write (`PackedDatasetBuilder`)
+
+Source files are handed to the readers one at a time from a shared queue and every stage pulls its next batch as soon
+as it is free, so a slow file or a slow batch only holds up the process working on it.
+
+Each source file is packed into its own series of chunks, in the order of its records, and the tokens left over after
+its last full chunk are set aside as its tail. A source is done once all of its chunks and its tail are written and it
+is recorded in an append-only ledger with its content hash, chunks and token counts. Re-runs skip the sources in the
+ledger and redo the ones that were interrupted or changed. Every run then appends the tails of the sources it
+prepared, in the order of their paths, to the `{prefix}_tails` chunks, so a re-run only ever adds chunks. The tokens
+that don't fill a last tails chunk are carried over to the next run.
+"""
+
+import glob
+import hashlib
+import json
+import multiprocessing as mp
+import os
+import queue
+import time
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+from lit_gpt.dedup import DedupIndex, add_counts, doc_hash
+from lit_gpt.packed_dataset import (
+    PackedDatasetBuilder,
+    auto_dtype,
+    build_manifest,
+    doc_index_path,
+    read_chunk,
+    read_doc_index,
+    write_chunk,
+    write_doc_index,
+)
+
+LEDGER_SUFFIX = ".ledger.jsonl"
+TAILS_DIR = "tails"
+TAILS_STATE_SUFFIX = "_tails.json"
+DEDUP_DIR = "dedup"
+
+
+def prepare_packed(
+    filenames: List[str],
+    read: Callable[[str], Iterable[Any]],
+    parse: Callable[[Any], Optional[Tuple[str, int]]],
+    tokenizer_path: Path,
+    source_path: Path,
+    destination_path: Path,
+    prefix: str,
+    chunk_size: int,
+    num_readers: int = 4,
+    num_workers: Optional[int] = None,
+    num_writers: int = 1,
+    batch_size: int = 256,
+    queue_size: int = 64,
+    write_remainder: bool = False,
+    dedup: bool = False,
+    dedup_capacity: int = 1 << 20,
+    num_buffers: int = 2,
+    fsync: bool = False,
+    source_names: Optional[List[str]] = None,
+    log_interval: float = 30.0,
+) -> None:
+    """Tokenize the records of `filenames` into chunks named `{prefix}_{source}_{counter}.bin` in
+    `destination_path`, where `source` is a hash of the path of the file relative to `source_path`.
+
+    `read` yields the raw records of a file and `parse` turns a record into its text and source id, or returns None to
+    drop it. Both run in child processes and must be picklable, i.e. defined at module level. The last, partially
+    filled chunk of tails is only written if `write_remainder`.
+
+    With `dedup`, documents whose normalized text was already packed, by this or an earlier run into
+    `destination_path`, are dropped before packing. The index of the packed documents starts with
+    `dedup_capacity` slots and doubles when it is half full. The documents and tokens dropped are reported per source id, named by
+    `source_names`. Which copy of a duplicate is kept depends on the order in which the sources are processed.
+
+    Each source is packed into `num_buffers` rotating chunk buffers, a full one is written by a thread while the next
+    one is filled. With `fsync`, chunks are flushed to disk before they appear in `destination_path`.
+    """
+    from lit_gpt import Tokenizer
+
+    destination_path.mkdir(parents=True, exist_ok=True)
+    (destination_path / TAILS_DIR).mkdir(exist_ok=True)
+    tokenizer = Tokenizer(tokenizer_path)
+    dtype = auto_dtype(tokenizer.vocab_size)
+    num_workers = num_workers or max(mp.cpu_count() - num_readers - num_writers, 1)
+
+    ledger_path = destination_path / f"{prefix}{LEDGER_SUFFIX}"
+    ledger = load_ledger(ledger_path)
+    sources = [os.path.relpath(filename, source_path) for filename in filenames]
+    todo = [i for i, source in enumerate(sources) if not _is_done(filenames[i], ledger.get(source))]
+    print(f"{len(filenames) - len(todo)} of {len(filenames)} source files are already prepared")
+    recover_tails(destination_path, prefix)
+    for i in todo:
+        # remove what an interrupted run or an older version of the source left behind
+        _remove_source(destination_path, prefix, sources[i])
+
+    dedup_args = None
+    if dedup:
+        DedupIndex.create(str(destination_path / DEDUP_DIR), dedup_capacity)
+        # documents this run added are told apart from the ones an interrupted run added for the same source
+        dedup_args = (str(destination_path / DEDUP_DIR), mp.Lock(), time.time_ns())
+
+    file_queue = mp.Queue()
+    for i in todo:
+        file_queue.put((i, filenames[i], sources[i]))
+    for _ in range(num_readers):
+        file_queue.put(None)
+    record_queue = mp.Queue(queue_size)
+    token_queues = [mp.Queue(queue_size) for _ in range(num_writers)]
+    stats_queue = mp.Queue()
+
+    readers = [
+        mp.Process(target=_read_worker, args=(read, file_queue, record_queue, batch_size))
+        for _ in range(num_readers)
+    ]
+    workers = [
+        mp.Process(
+            target=_tokenize_worker, args=(tokenizer_path, parse, dtype, dedup_args, record_queue, token_queues)
+        )
+        for _ in range(num_workers)
+    ]
+    writers = [
+        mp.Process(
+            target=_write_worker,
+            args=(
+                destination_path,
+                prefix,
+                chunk_size,
+                tokenizer.bos_id,
+                dtype,
+                num_buffers,
+                fsync,
+                token_queue,
+                stats_queue,
+            ),
+        )
+        for token_queue in token_queues
+    ]
+    processes = readers + workers + writers
+    for p in processes:
+        p.start()
+
+    meter = ProgressMeter(len(todo), log_interval)
+    with open(ledger_path, "a") as ledger_file:
+        try:
+            # each stage is told to stop once the stage feeding it has finished
+            _wait(readers, processes, stats_queue, meter, ledger_file)
+            for _ in workers:
+                record_queue.put(None)
+            _wait(workers, processes, stats_queue, meter, ledger_file)
+            for token_queue in token_queues:
+                token_queue.put(None)
+            _wait(writers, processes, stats_queue, meter, ledger_file)
+        except BaseException:
+            for p in processes:
+                p.terminate()
+            raise
+    meter.log()
+    if dedup:
+        meter.log_duplicates(source_names)
+
+    pack_tails(destination_path, prefix, chunk_size, tokenizer.bos_id, dtype, write_remainder)
+    # merge the manifests written for each source into the manifest of the destination directory
+    build_manifest(destination_path)
+
+
+def load_ledger(path: Path) -> Dict[str, dict]:
+    """Return the latest ledger entry of every source."""
+    ledger = {}
+    if path.is_file():
+        with open(path) as f:
+            for line in f:
+                if line.strip():
+                    entry = json.loads(line)
+                    ledger[entry["source"]] = entry
+    return ledger
+
+
+def pack_tails(
+    destination_path: Path, prefix: str, chunk_size: int, sep_token: int, dtype, write_remainder: bool
+) -> None:
+    """Append the tails of the sources in the ledger that were not packed yet, in the order of their paths, to the
+    `{prefix}_tails` chunks.
+
+    The chunks that were already written are never changed. The tokens that don't fill a chunk are kept as the
+    remainder in the tails directory and packed first by the next call, or written as a last, padded chunk if
+    `write_remainder`. A tail is deleted once it is packed, so a source that is prepared again after its tail was
+    packed adds its new tail, and the old one stays in the tails chunks.
+    """
+    state = _load_tails_state(destination_path, prefix)
+    ledger = load_ledger(destination_path / f"{prefix}{LEDGER_SUFFIX}")
+    tail_paths = [_tail_path(destination_path, prefix, source) for source in sorted(ledger)]
+    tail_paths = [path for path in tail_paths if os.path.isfile(path)]
+    remainder_path = _remainder_path(destination_path, prefix, state["generation"])
+    has_remainder = os.path.isfile(remainder_path)
+    if not tail_paths and not (write_remainder and has_remainder):
+        return
+
+    builder = PackedDatasetBuilder(
+        outdir=destination_path,
+        prefix=f"{prefix}_tails",
+        chunk_size=chunk_size,
+        sep_token=sep_token,
+        dtype=dtype,
+        counter=state["counter"],
+    )
+    for path in ([remainder_path] if has_remainder else []) + tail_paths:
+        tokens = np.asarray(read_chunk(path))
+        # a tail starts with a document, possibly the end of one that started in the last chunk of the source
+        doc_starts, source_ids = read_doc_index(path)
+        doc_ends = np.append(doc_starts[1:], len(tokens))
+        for i, (start, end, source_id) in enumerate(zip(doc_starts, doc_ends, source_ids)):
+            continues = path == remainder_path and i == 0 and state["continues"]
+            builder.add_array(tokens[start:end], source_id=int(source_id), continues=continues)
+    if write_remainder and len(builder.remainder()[0]):
+        builder.write_reminder()
+    builder.close()
+    builder.write_manifest()
+
+    # the new remainder and state are written before the packed tails are deleted, see `recover_tails`
+    generation = state["generation"] + 1
+    tokens, doc_starts, doc_sources = builder.remainder()
+    if len(tokens):
+        new_remainder_path = _remainder_path(destination_path, prefix, generation)
+        with open(new_remainder_path, "wb") as f:
+            write_chunk(f, tokens)
+        write_doc_index(new_remainder_path, doc_starts, doc_sources)
+    packed = tail_paths + ([remainder_path] if has_remainder else [])
+    state = {
+        "generation": generation,
+        "counter": state["counter"] + len(builder.filenames),
+        "continues": builder.continues,
+        "packed": [os.path.basename(path) for path in packed],
+    }
+    _save_tails_state(destination_path, prefix, state)
+    recover_tails(destination_path, prefix)
+
+
+def recover_tails(destination_path: Path, prefix: str) -> None:
+    """Finish or roll back a `pack_tails` that was interrupted.
+
+    Until its state is saved, the chunks it wrote are deleted and the tails are packed again. After that, the tails it
+    packed are deleted.
+    """
+    state = _load_tails_state(destination_path, prefix)
+    for counter, path in _tails_chunks(destination_path, prefix):
+        if counter >= state["counter"]:
+            for chunk_path in (path, doc_index_path(path)):
+                if os.path.isfile(chunk_path):
+                    os.remove(chunk_path)
+    tails_path = destination_path / TAILS_DIR
+    for name in state["packed"]:
+        for path in (str(tails_path / name), doc_index_path(str(tails_path / name))):
+            if os.path.isfile(path):
+                os.remove(path)
+    if state["packed"]:
+        _save_tails_state(destination_path, prefix, {**state, "packed": []})
+
+
+def _tails_state_path(destination_path: Path, prefix: str) -> Path:
+    return destination_path / TAILS_DIR / f"{prefix}{TAILS_STATE_SUFFIX}"
+
+
+def _tails_chunks(destination_path: Path, prefix: str) -> List[Tuple[int, str]]:
+    chunks = []
+    for path in glob.glob(str(destination_path / f"{prefix}_tails_*.bin")):
+        counter = os.path.basename(path)[len(f"{prefix}_tails_") : -len(".bin")]
+        if counter.isdigit():
+            chunks.append((int(counter), path))
+    return chunks
+
+
+def _load_tails_state(destination_path: Path, prefix: str) -> dict:
+    path = _tails_state_path(destination_path, prefix)
+    if not path.is_file():
+        # tails chunks written before the state was kept were packed from all the tails in the tails directory
+        counters = [counter for counter, _ in _tails_chunks(destination_path, prefix)]
+        tails = glob.glob(str(destination_path / TAILS_DIR / f"{prefix}_*.bin")) if counters else []
+        packed = [os.path.basename(tail) for tail in tails]
+        return {"generation": 0, "counter": max(counters, default=-1) + 1, "continues": False, "packed": packed}
+    with open(path) as f:
+        return json.load(f)
+
+
+def _save_tails_state(destination_path: Path, prefix: str, state: dict) -> None:
+    path = _tails_state_path(destination_path, prefix)
+    tmp_path = str(path) + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(state, f)
+    os.replace(tmp_path, path)
+
+
+def _remainder_path(destination_path: Path, prefix: str, generation: int) -> str:
+    return str(destination_path / TAILS_DIR / f"{prefix}_remainder_{generation}.bin")
+
+
+class ProgressMeter:
+    """Counts the files, documents and tokens that passed through the pipeline and logs the throughput."""
+
+    def __init__(self, n_files: int, log_interval: float) -> None:
+        self.n_files = n_files
+        self.log_interval = log_interval
+        self.files = self.docs = self.tokens = 0
+        self.duplicates = {}  # {source_id: [documents, tokens]} dropped as duplicates
+        self.t0 = self._last_time = time.perf_counter()
+        self._last_tokens = 0
+
+    def update(self, files: int, docs: int, tokens: int, duplicates: Optional[Dict[int, List[int]]] = None) -> None:
+        self.files += files
+        self.docs += docs
+        self.tokens += tokens
+        for source_id, (dup_docs, dup_tokens) in (duplicates or {}).items():
+            count = self.duplicates.setdefault(source_id, [0, 0])
+            count[0] += dup_docs
+            count[1] += dup_tokens
+        if time.perf_counter() - self._last_time >= self.log_interval:
+            self.log()
+
+    def log(self) -> None:
+        t = time.perf_counter()
+        recent = (self.tokens - self._last_tokens) / max(t - self._last_time, 1e-9)
+        duplicates = f", {sum(tokens for _, tokens in self.duplicates.values())} duplicate tokens dropped"
+        print(
+            f"files {self.files}/{self.n_files}, {self.docs} documents, {self.tokens} tokens"
+            f"{duplicates if self.duplicates else ''},"
+            f" {recent:,.0f} tokens/sec ({self.tokens / max(t - self.t0, 1e-9):,.0f} overall)"
+        )
+        self._last_time = t
+        self._last_tokens = self.tokens
+
+    def log_duplicates(self, source_names: Optional[List[str]] = None) -> None:
+        for source_id, (docs, tokens) in sorted(self.duplicates.items()):
+            name = source_names[source_id] if source_names is not None else source_id
+            print(f"{name}: dropped {docs} duplicate documents, {tokens} tokens")
+
+
+def _source_key(source: str) -> str:
+    return hashlib.blake2b(source.encode(), digest_size=8).hexdigest()
+
+
+def _tail_path(destination_path: Path, prefix: str, source: str) -> str:
+    return str(destination_path / TAILS_DIR / f"{prefix}_{_source_key(source)}.bin")
+
+
+def _remove_source(destination_path: Path, prefix: str, source: str) -> None:
+    tail_path = _tail_path(destination_path, prefix, source)
+    paths = glob.glob(str(destination_path / f"{prefix}_{_source_key(source)}_*")) + [
+        tail_path,
+        doc_index_path(tail_path),
+    ]
+    for path in paths:
+        if os.path.isfile(path):
+            os.remove(path)
+
+
+def _file_hash(filename: str) -> str:
+    file_hash = hashlib.blake2b(digest_size=16)
+    with open(filename, "rb") as f:
+        while block := f.read(1 << 20):
+            file_hash.update(block)
+    return file_hash.hexdigest()
+
+
+def _is_done(filename: str, entry: Optional[dict]) -> bool:
+    if entry is None:
+        return False
+    stat = os.stat(filename)
+    if (stat.st_size, stat.st_mtime_ns) == (entry["size"], entry["mtime_ns"]):
+        return True
+    # touched, but only a change of its contents requires preparing it again
+    return _file_hash(filename) == entry["hash"]
+
+
+def _wait(processes, all_processes, stats_queue, meter, ledger_file):
+    def handle(message):
+        kind, data = message
+        if kind == "source":
+            # the source is written completely, record it
+            ledger_file.write(json.dumps(data) + "\n")
+            ledger_file.flush()
+            meter.update(1, 0, 0)
+        else:
+            meter.update(0, *data)
+
+    while True:
+        try:
+            handle(stats_queue.get(timeout=1.0))
+            continue
+        except queue.Empty:
+            pass
+        failed = [p for p in all_processes if p.exitcode not in (None, 0)]
+        if failed:
+            raise RuntimeError(f"{len(failed)} pipeline processes failed, exit codes {[p.exitcode for p in failed]}")
+        if not any(p.is_alive() for p in processes):
+            break
+    # collect the stats that were sent right before the processes exited
+    while True:
+        try:
+            handle(stats_queue.get_nowait())
+        except queue.Empty:
+            break
+
+
+# batch indices of the messages that start and end a source
+_START = -1
+_END = -2
+
+
+def _read_worker(read, file_queue, record_queue, batch_size):
+    while (task := file_queue.get()) is not None:
+        file_idx, filename, source = task
+        print(f"Processing {filename}")
+        stat = os.stat(filename)
+        info = {"source": source, "size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "hash": _file_hash(filename)}
+        record_queue.put((file_idx, _START, info))
+        owner = int(_source_key(source), 16)
+        n_batches = 0
+        batch = []
+        for record in read(filename):
+            batch.append(record)
+            if len(batch) == batch_size:
+                record_queue.put((file_idx, n_batches, (owner, batch)))
+                n_batches += 1
+                batch = []
+        if batch:
+            record_queue.put((file_idx, n_batches, (owner, batch)))
+            n_batches += 1
+        # tells the writer how many batches to expect, they may arrive in any order
+        record_queue.put((file_idx, _END, n_batches))
+
+
+def _tokenize_worker(tokenizer_path, parse, dtype, dedup_args, record_queue, token_queues):
+    from lit_gpt import Tokenizer
+
+    tokenizer = Tokenizer(tokenizer_path)
+    if dedup_args is not None:
+        dedup_path, lock, generation = dedup_args
+        dedup_index = DedupIndex(dedup_path, lock)
+    while (item := record_queue.get()) is not None:
+        file_idx, batch_idx, payload = item
+        # all batches of a source go to the same writer
+        token_queue = token_queues[file_idx % len(token_queues)]
+        if batch_idx < 0:
+            token_queue.put(item)
+            continue
+        owner, records = payload
+        texts, source_ids = [], []
+        for record in records:
+            parsed = parse(record)
+            if parsed is not None:
+                texts.append(parsed[0])
+                source_ids.append(parsed[1])
+        # one flat array per batch is much cheaper to send to the writers than one array per document
+        tokens, offsets = tokenizer.encode_batch(texts, dtype=dtype, flat=True, num_threads=1)
+        duplicates = {}
+        if dedup_args is not None:
+            keep = dedup_index.add([doc_hash(text) for text in texts], owner, generation)
+            lengths = np.diff(offsets)
+            add_counts(duplicates, np.asarray(source_ids)[~keep], lengths[~keep])
+            tokens = tokens[np.repeat(keep, lengths)]
+            offsets = np.concatenate([[0], np.cumsum(lengths[keep])])
+            source_ids = [source_id for source_id, k in zip(source_ids, keep) if k]
+        token_queue.put((file_idx, batch_idx, (tokens, offsets, source_ids, duplicates)))
+
+
+class _SourceWriter:
+    """Packs the batches of one source in their original order."""
+
+    def __init__(self, destination_path, prefix, chunk_size, sep_token, dtype, num_buffers, fsync):
+        self.destination_path = destination_path
+        self.prefix = prefix
+        self.builder_args = dict(
+            outdir=destination_path,
+            chunk_size=chunk_size,
+            sep_token=sep_token,
+            dtype=dtype,
+            num_buffers=num_buffers,
+            fsync=fsync,
+        )
+        self.builder = None
+        self.pending = {}
+        self.next_batch = 0
+        self.n_batches = None
+        self.info = None
+        self.n_docs = 0
+        self.n_tokens = 0
+        self.n_dup_docs = 0
+        self.n_dup_tokens = 0
+
+    def add(self, batch_idx, batch):
+        if batch_idx == _START:
+            self.info = batch
+            self.builder = PackedDatasetBuilder(
+                prefix=f"{self.prefix}_{_source_key(self.info['source'])}", **self.builder_args
+            )
+        elif batch_idx == _END:
+            self.n_batches = batch
+        else:
+            self.pending[batch_idx] = batch
+        if self.builder is None:
+            return
+        while self.next_batch in self.pending:
+            tokens, offsets, source_ids, duplicates = self.pending.pop(self.next_batch)
+            for start, end, source_id in zip(offsets[:-1], offsets[1:], source_ids):
+                self.builder.add_array(tokens[start:end], source_id=source_id)
+            self.n_docs += len(source_ids)
+            self.n_tokens += len(tokens)
+            self.n_dup_docs += sum(docs for docs, _ in duplicates.values())
+            self.n_dup_tokens += sum(tokens for _, tokens in duplicates.values())
+            self.next_batch += 1
+
+    @property
+    def done(self):
+        return self.n_batches is not None and self.next_batch == self.n_batches
+
+    def finish(self):
+        """Set the tokens after the last full chunk aside as the tail of the source and return its ledger entry."""
+        tokens, doc_starts, doc_sources = self.builder.remainder()
+        tail_path = _tail_path(self.destination_path, self.prefix, self.info["source"])
+        if len(tokens):
+            with open(tail_path, "wb") as f:
+                write_chunk(f, tokens)
+            write_doc_index(tail_path, doc_starts, doc_sources)
+        self.builder.close()
+        self.builder.write_manifest()
+        return {
+            **self.info,
+            "chunks": [os.path.basename(filename) for filename in self.builder.filenames],
+            "n_docs": self.n_docs,
+            "n_tokens": self.n_tokens,
+            "n_dup_docs": self.n_dup_docs,
+            "n_dup_tokens": self.n_dup_tokens,
+            "tail_tokens": len(tokens),
+        }
+
+
+def _write_worker(destination_path, prefix, chunk_size, sep_token, dtype, num_buffers, fsync, token_queue, stats_queue):
+    sources = {}
+    while (item := token_queue.get()) is not None:
+        file_idx, batch_idx, batch = item
+        if file_idx not in sources:
+            sources[file_idx] = _SourceWriter(
+                destination_path, prefix, chunk_size, sep_token, dtype, num_buffers, fsync
+            )
+        source = sources[file_idx]
+        source.add(batch_idx, batch)
+        if batch_idx >= 0:
+            tokens, _, source_ids, duplicates = batch
+            stats_queue.put(("tokens", (len(source_ids), len(tokens), duplicates)))
+        if source.done:
+            stats_queue.put(("source", source.finish()))
+            del sources[file_idx]
@@ -163,6 +163,9 @@ class SpeedMonitorBase:
     +-------------------------------------+-----------------------------------------------------------+
     | `time/total`                        | Total elapsed time (time/train + time/val)                |
     +-------------------------------------+-----------------------------------------------------------+
+    | `time/data`                         | Total time the training loop was blocked waiting on data. |
+    |                                     | Only logged when `data_elapsed` is passed                 |
+    +-------------------------------------+-----------------------------------------------------------+
 
     Notes:
         - The implementation assumes that devices are homogeneous as it normalizes by the world size.
@@ -225,6 +228,7 @@ class SpeedMonitorBase:
         flops_per_batch: Optional[int] = None,  # (per device)
         lengths: Optional[int] = None,  # total length of the samples seen (per device)
         train_loss: Optional[float] = None,
+        data_elapsed: Optional[float] = None,  # total time spent waiting on data (seconds)
     ):
         self.iter += 1
         metrics = {}
@@ -291,6 +295,8 @@ class SpeedMonitorBase:
                 "samples": samples,
             }
         )
+        if data_elapsed is not None:
+            metrics["time/data"] = data_elapsed / self.divider
         if self.iter % self.log_iter_interval == 0:
             self.log_dict(metrics, step_count)
 
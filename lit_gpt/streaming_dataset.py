@@ -0,0 +1,143 @@
+"""Tokenizes raw text shards while training, for experiments too small to be worth preparing packed chunks for."""
+
+import json
+import os
+from itertools import islice
+from pathlib import Path
+from typing import Callable, Iterable, Iterator, List
+
+import numpy as np
+import torch
+from torch.utils.data import IterableDataset, get_worker_info
+
+from lit_gpt.packed_dataset import auto_dtype
+
+
+def read_jsonl(path: str, key: str = "text") -> Iterator[str]:
+    """Yield the `key` field of every line of a `.jsonl` or zstd compressed `.jsonl.zst` file."""
+    if path.endswith(".zst"):
+        import zstandard as zstd
+
+        f = zstd.open(open(path, "rb"), "rt", encoding="utf-8")
+    else:
+        f = open(path, encoding="utf-8")
+    with f:
+        for line in f:
+            yield json.loads(line)[key]
+
+
+def read_parquet(path: str, column: str = "content", batch_size: int = 1024) -> Iterator[str]:
+    """Yield the `column` of a parquet file, read in record batches."""
+    import pyarrow.parquet as pq
+
+    for batch in pq.ParquetFile(path).iter_batches(batch_size, columns=[column]):
+        yield from batch.column(0).to_pylist()
+
+
+def read_texts(path: str) -> Iterator[str]:
+    """Yield the texts of a SlimPajama `.jsonl(.zst)` or StarCoder `.parquet` file."""
+    if path.endswith(".parquet"):
+        return read_parquet(path)
+    return read_jsonl(path)
+
+
+def worker_init_fn(worker_id: int) -> None:
+    """Keep the tokenizer of a DataLoader worker on one thread.
+
+    Every worker tokenizes its own shard, and the Rust tokenizer of the Hugging Face backend otherwise starts a thread
+    pool over all cores in each of them. It ignores `num_threads`, its pool is sized from the environment when it is
+    first used.
+    """
+    os.environ["RAYON_NUM_THREADS"] = "1"
+    os.environ["TOKENIZERS_PARALLELISM"] = "false"
+
+
+class TokenizingDataset(IterableDataset):
+    """Blocks of `block_size` tokens packed from raw text files, tokenized in the DataLoader workers.
+
+    The files are sharded over processes and workers like in `PackedDataset`, and the documents of a shard are
+    tokenized in batches of `batch_size`, separated by EOS and packed back to back into blocks. With `shuffle`, the
+    order of the files is shuffled every epoch and the blocks are drawn at random from a buffer of `buffer_size`
+    blocks. `read` yields the texts of a file. Unless `wrap`, the iteration ends after one pass over the files. In
+    DataLoader workers, the tokenizer runs on one thread, see `worker_init_fn`.
+    """
+
+    def __init__(
+        self,
+        filenames: List[str],
+        tokenizer_path: Path,
+        block_size: int,
+        seed: int = 12345,
+        shuffle: bool = True,
+        buffer_size: int = 8192,
+        batch_size: int = 256,
+        wrap: bool = True,
+        num_processes: int = 1,
+        process_rank: int = 0,
+        read: Callable[[str], Iterable[str]] = read_texts,
+    ) -> None:
+        self._filenames = filenames
+        self._tokenizer_path = tokenizer_path
+        self._block_size = block_size
+        self._seed = seed
+        self._shuffle = shuffle
+        self._buffer_size = buffer_size
+        self._batch_size = batch_size
+        self._wrap = wrap
+        self._num_processes = num_processes
+        self._process_rank = process_rank
+        self._read = read
+
+    def __iter__(self) -> Iterator[torch.Tensor]:
+        worker_info = get_worker_info()
+        num_workers = worker_info.num_workers if worker_info is not None else 1
+        worker_id = worker_info.id if worker_info is not None else 0
+        if worker_info is not None:
+            worker_init_fn(worker_id)
+        return self._iterator(worker_id, num_workers)
+
+    def _iterator(self, worker_id: int, num_workers: int) -> Iterator[torch.Tensor]:
+        num_shards = num_workers * self._num_processes
+        shard_id = self._process_rank * num_workers + worker_id
+        if len(self._filenames) < num_shards:
+            raise ValueError(f"{len(self._filenames)} files can't be sharded over {num_shards} workers.")
+
+        max_num_files = len(self._filenames) // num_shards * num_shards
+        filenames = self._filenames[shard_id:max_num_files:num_shards]
+        rng = np.random.default_rng([self._seed, shard_id])
+        blocks = self._blocks(filenames, rng)
+        if self._shuffle:
+            blocks = self._shuffled(blocks, rng)
+        return (torch.from_numpy(block.astype(np.int64)) for block in blocks)
+
+    def _blocks(self, filenames: List[str], rng: np.random.Generator) -> Iterator[np.ndarray]:
+        from lit_gpt import Tokenizer
+
+        tokenizer = Tokenizer(self._tokenizer_path)
+        dtype = auto_dtype(tokenizer.vocab_size)
+        # tokens that did not fill a block yet, continued by the next batch
+        rest = np.empty(0, dtype=dtype)
+        while True:
+            order = rng.permutation(len(filenames)) if self._shuffle else range(len(filenames))
+            for file_idx in order:
+                texts = iter(self._read(filenames[file_idx]))
+                while batch := list(islice(texts, self._batch_size)):
+                    tokens, _ = tokenizer.encode_batch(batch, dtype=dtype, flat=True, num_threads=1)
+                    tokens = np.concatenate([rest, tokens])
+                    n_blocks = len(tokens) // self._block_size
+                    yield from tokens[: n_blocks * self._block_size].reshape(n_blocks, self._block_size)
+                    rest = tokens[n_blocks * self._block_size :]
+            if not self._wrap:
+                return
+
+    def _shuffled(self, blocks: Iterator[np.ndarray], rng: np.random.Generator) -> Iterator[np.ndarray]:
+        buffer = []
+        for block in blocks:
+            if len(buffer) < self._buffer_size:
+                buffer.append(block)
+                continue
+            i = rng.integers(self._buffer_size)
+            yield buffer[i]
+            buffer[i] = block
+        rng.shuffle(buffer)
+        yield from buffer
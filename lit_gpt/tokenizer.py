@@ -1,7 +1,9 @@
 import json
+from itertools import chain
 from pathlib import Path
-from typing import Optional
+from typing import List, Optional, Tuple, Union
 
+import numpy as np
 import torch
 
 
@@ -72,6 +74,41 @@ class Tokenizer:
             tokens = tokens[:max_length]
         return torch.tensor(tokens, dtype=torch.int, device=device)
 
+    def encode_batch(
+        self,
+        strings: List[str],
+        bos: bool = False,
+        eos: bool = True,
+        max_length: int = -1,
+        dtype: np.dtype = np.int32,
+        flat: bool = False,
+        num_threads: int = -1,
+    ) -> Union[List[np.ndarray], Tuple[np.ndarray, np.ndarray]]:
+        """Encode `strings` on `num_threads` threads (all cores if -1), the same as `encode` for each string.
+
+        Returns one array per string, or if `flat` a single array of all tokens and the `len(strings) + 1` offsets at
+        which the tokens of each string start and the last one ends.
+        """
+        if bos and self.bos_id is None:
+            raise NotImplementedError("This tokenizer does not defined a bos token")
+        if self.backend == "huggingface":
+            # the Rust tokenizer parallelizes over the batch, its thread pool is sized by RAYON_NUM_THREADS
+            batch = [encoding.ids for encoding in self.processor.encode_batch(strings)]
+            if bos or eos:
+                batch = [([self.bos_id] if bos else []) + tokens + ([self.eos_id] if eos else []) for tokens in batch]
+        elif self.backend == "sentencepiece":
+            batch = self.processor.encode(strings, add_bos=bos, add_eos=eos, num_threads=num_threads)
+        else:
+            raise RuntimeError
+        if max_length > 0:
+            batch = [tokens[:max_length] for tokens in batch]
+
+        if not flat:
+            return [np.array(tokens, dtype=dtype) for tokens in batch]
+        offsets = np.zeros(len(batch) + 1, dtype=np.int64)
+        np.cumsum([len(tokens) for tokens in batch], out=offsets[1:])
+        return np.fromiter(chain.from_iterable(batch), dtype=dtype, count=int(offsets[-1])), offsets
+
     def decode(self, tensor: torch.Tensor) -> str:
         tokens = [tensor.item()] if tensor.ndim == 0 else tensor.tolist()
         return self.processor.decode(tokens)
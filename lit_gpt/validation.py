@@ -0,0 +1,83 @@
+"""A fixed validation set that is read once and evaluated without host syncs."""
+
+from typing import List, Optional
+
+import numpy as np
+import torch
+import torch.distributed as dist
+
+from lit_gpt.chunk_source import ChunkCache
+from lit_gpt.packed_dataset import close_chunk, read_chunk, to_token_ids
+
+
+class ValidationSet:
+    """The first `max_batches` batches of `batch_size` blocks of the chunks `filenames`, split over the processes.
+
+    The blocks of all chunks are split over the processes like in `PackedBlockDataset` with `GlobalShuffleSampler`,
+    block `i` goes to process `i % num_processes`, so every process gets the same number of blocks give or take one
+    however few chunks there are. Every process reads its blocks once and keeps them in host memory, pinned if
+    `device` is a GPU, in the token dtype of the chunks. They are copied to `device` one batch at a time. All
+    processes keep the same number of batches, because a sharded model has to run the same number of forward passes
+    on all of them. With `chunk_cache`, only the chunks that are read are fetched.
+    """
+
+    def __init__(
+        self,
+        filenames: List[str],
+        block_size: int,
+        batch_size: int,
+        max_batches: int,
+        device: torch.device,
+        num_processes: int = 1,
+        process_rank: int = 0,
+        chunk_cache: Optional[ChunkCache] = None,
+    ) -> None:
+        blocks = []
+        n_blocks = 0
+        first_block = 0  # index of the first block of the next chunk over all chunks
+        for filename in filenames:
+            if n_blocks >= max_batches * batch_size:
+                break
+            tokens = read_chunk(filename) if chunk_cache is None else chunk_cache.open(filename, read_chunk)
+            n = len(tokens) // block_size
+            rows = np.arange((process_rank - first_block) % num_processes, n, num_processes)
+            rows = rows[: max_batches * batch_size - n_blocks]
+            blocks.append(np.asarray(tokens[: n * block_size]).reshape(n, block_size)[rows])
+            close_chunk(tokens)
+            n_blocks += len(rows)
+            first_block += n
+
+        self.device = torch.device(device)
+        n_batches = torch.tensor(n_blocks // batch_size, device=self.device)
+        if dist.is_available() and dist.is_initialized():
+            dist.all_reduce(n_batches, op=dist.ReduceOp.MIN)
+        self.n_batches = int(n_batches)
+        if self.n_batches == 0:
+            raise ValueError(f"A process has less than {batch_size} blocks of validation data.")
+
+        arr = np.concatenate(blocks)[: self.n_batches * batch_size]
+        if arr.dtype == np.uint16:
+            arr = arr.view(np.int16)  # widened again by `to_token_ids`
+        self.batches = torch.from_numpy(arr).view(self.n_batches, batch_size, block_size)
+        if self.device.type == "cuda":
+            self.batches = self.batches.pin_memory()
+
+    @torch.no_grad()
+    def evaluate(self, model: torch.nn.Module, n_batches: Optional[int] = None) -> torch.Tensor:
+        """Return the mean loss per token over the first `n_batches` batches (all if None) of all processes.
+
+        The summed loss stays on the device and is all-reduced once, so the only sync is reading the result.
+        """
+        n_batches = self.n_batches if n_batches is None else min(n_batches, self.n_batches)
+        totals = torch.zeros(2, dtype=torch.float64, device=self.device)
+        for batch in self.batches[:n_batches]:
+            batch = to_token_ids(batch.to(self.device, non_blocking=True))
+            input_ids, targets = batch[:, :-1].contiguous(), batch[:, 1:].contiguous()
+            logits = model(input_ids)
+            totals[0] += torch.nn.functional.cross_entropy(
+                logits.reshape(-1, logits.size(-1)), targets.reshape(-1), reduction="sum"
+            )
+            totals[1] += targets.numel()
+        if dist.is_available() and dist.is_initialized():
+            dist.all_reduce(totals)
+        return (totals[0] / totals[1]).float()
@@ -6,21 +6,36 @@ from pathlib import Path
 from typing import Optional, Tuple, Union
 import math
 import lightning as L
+import numpy as np
 import torch
 from lightning.fabric.strategies import FSDPStrategy, XLAStrategy
 from torch.utils.data import DataLoader
-from functools import partial
 # support running without installing as a package
 wd = Path(__file__).parent.parent.resolve()
 sys.path.append(str(wd))
 # from apex.optimizers import FusedAdam #torch optimizer has a cuda backend, which is faster actually
+from lit_gpt.chunk_source import ChunkCache
 from lit_gpt.model import GPT, Block, Config, CausalSelfAttention
-from lit_gpt.packed_dataset import CombinedDataset, PackedDataset
+from lit_gpt.packed_dataset import (
+    MANIFEST_NAME,
+    CombinedDataset,
+    GlobalShuffleSampler,
+    PackedBlockDataset,
+    PackedDataset,
+    SeqLenSchedule,
+    dtypes,
+    load_manifest,
+    read_header,
+    select_manifest,
+    split_blocks,
+    to_token_ids,
+)
 from lit_gpt.speed_monitor import SpeedMonitorFabric as Monitor
 from lit_gpt.speed_monitor import estimate_flops, measure_flops
-from lit_gpt.utils import chunked_cross_entropy, get_default_supported_precision, num_parameters, step_csv_logger, lazy_load
+from lit_gpt.validation import ValidationSet
+from lit_gpt.utils import get_default_supported_precision, num_parameters, step_csv_logger, lazy_load
 from pytorch_lightning.loggers import WandbLogger
-from lit_gpt import FusedCrossEntropyLoss
+from lit_gpt import CrossEntropyLoss
 import random
 
 
@@ -38,6 +53,7 @@ max_step = 10000
 warmup_steps = 0 
 log_step_interval = 1
 eval_iters = 1000000
+eval_subset_iters = 100
 save_step_interval = 2000
 eval_step_interval = 2000
 
@@ -46,6 +62,16 @@ beta1 = 0.9
 beta2 = 0.95
 grad_clip = 1.0
 decay_lr = True
+# shuffle the blocks of all training chunks globally instead of within windows of chunks, needs a manifest
+global_shuffle = False
+# train on shorter sequences split from the same blocks over the first `seq_len_warmup_steps` steps, the tokens per
+# step stay the same (see `SeqLenSchedule`)
+seq_len_warmup_steps = 0
+min_seq_len = 256
+# with a cache directory, the data directories are read through an LRU cache of `chunk_cache_bytes` on the local disk,
+# they can be HTTP URLs or slow directories like network mounts (see `lit_gpt.chunk_source`)
+chunk_cache_dir = None
+chunk_cache_bytes = 1 << 40
 
 batch_size = global_batch_size // num_of_devices
 gradient_accumulation_steps = batch_size // micro_batch_size
@@ -61,8 +87,9 @@ log_iter_interval = log_step_interval * gradient_accumulation_steps
 
 
 # Treat all dataset equally by their size. If you want to use a different weight for a dataset, add it to the list with the weight.
+# A weight of None weights the dataset by its token count in the manifest of the data directory.
 train_data_config = [
-    ("train_starcoder", 1),
+    ("train_starcoder", None),
 ]
 
 val_data_config = [
@@ -114,7 +141,7 @@ def main(fabric, train_data_dir, val_data_dir, resume):
 
     config = Config.from_name(model_name)
 
-    train_dataloader, val_dataloader = create_dataloaders(
+    train_dataloader, val_set = create_dataloaders(
         batch_size=micro_batch_size,
         block_size=config.block_size,
         fabric=fabric,
@@ -122,10 +149,7 @@ def main(fabric, train_data_dir, val_data_dir, resume):
         val_data_dir=val_data_dir,
         seed=3407,
     )
-    if val_dataloader is None:
-        train_dataloader = fabric.setup_dataloaders(train_dataloader)
-    else:
-        train_dataloader, val_dataloader = fabric.setup_dataloaders(train_dataloader, val_dataloader)
+    train_dataloader = fabric.setup_dataloaders(train_dataloader, use_distributed_sampler=False)
 
     fabric.seed_everything(3407)  # same seed for every process to init model (FSDP)
 
@@ -157,21 +181,25 @@ def main(fabric, train_data_dir, val_data_dir, resume):
         resume = sorted(out_dir.glob("*.pth"))[-1]
     if resume :
         fabric.print(f"Resuming training from {resume}")
-        fabric.load(resume, state)
+        remainder = fabric.load(resume, state)
+        if "train_data" in remainder:
+            # jump straight to the saved position of the data iterators instead of replaying the dataloader
+            data_source(train_dataloader).load_state_dict(remainder["train_data"][fabric.global_rank])
+            resume = False
 
     train_time = time.perf_counter()
-    train(fabric, state, train_dataloader, val_dataloader, monitor, resume)
+    train(fabric, state, train_dataloader, val_set, monitor, resume)
     fabric.print(f"Training time: {(time.perf_counter()-train_time):.2f}s")
     if fabric.device.type == "cuda":
         fabric.print(f"Memory used: {torch.cuda.max_memory_allocated() / 1e9:.02f} GB")
 
 
-def train(fabric, state, train_dataloader, val_dataloader, monitor, resume):
+def train(fabric, state, train_dataloader, val_set, monitor, resume):
     model = state["model"]
     optimizer = state["optimizer"]
 
-    if val_dataloader is not None:
-        validate(fabric, model, val_dataloader)  # sanity check
+    if val_set is not None:
+        validate(fabric, model, val_set, eval_subset_iters)  # sanity check
 
     with torch.device("meta"):
         meta_model = GPT(model.config)
@@ -197,9 +225,16 @@ def train(fabric, state, train_dataloader, val_dataloader, monitor, resume):
     
     initial_iter = state["iter_num"]
     curr_iter = 0
+    # number of batches the dataloader yielded before this run, in case it has to be replayed on resume
+    replayed_iters = initial_iter if resume else 0
             
-    loss_func = FusedCrossEntropyLoss()
+    loss_func = CrossEntropyLoss()
+    seq_len_schedule = SeqLenSchedule(model.config.block_size, min_seq_len, seq_len_warmup_steps)
+    data_time = 0.0
+    data_t0 = time.perf_counter()
     for  train_data in train_dataloader:
+        # time the loop was blocked waiting on the dataloader
+        data_time += time.perf_counter() - data_t0
         # resume loader state. This is not elegant but it works. Should rewrite it in the future.
         if resume:
             if curr_iter < initial_iter:
@@ -219,8 +254,10 @@ def train(fabric, state, train_dataloader, val_dataloader, monitor, resume):
             param_group["lr"] = lr
 
         iter_t0 = time.perf_counter()
-        input_ids = train_data[:, 0 : model.config.block_size].contiguous()
-        targets = train_data[:, 1 : model.config.block_size + 1].contiguous()
+        seq_len = seq_len_schedule(state["step_count"])
+        train_data = split_blocks(to_token_ids(train_data), seq_len)
+        input_ids = train_data[:, 0:seq_len].contiguous()
+        targets = train_data[:, 1 : seq_len + 1].contiguous()
 
         is_accumulating = (state["iter_num"] + 1) % gradient_accumulation_steps != 0
         with fabric.no_backward_sync(model, enabled=is_accumulating):
@@ -238,7 +275,8 @@ def train(fabric, state, train_dataloader, val_dataloader, monitor, resume):
             xm.mark_step()
         state["iter_num"] += 1
         # input_id: B L 
-        total_lengths += input_ids.size(1)
+        # tokens per block, also while the blocks are split into shorter sequences
+        total_lengths += input_ids.numel() // micro_batch_size
         t1 = time.perf_counter()
         fabric.print(
                 f"iter {state['iter_num']} step {state['step_count']}: loss {loss.item():.4f}, iter time:"
@@ -256,59 +294,101 @@ def train(fabric, state, train_dataloader, val_dataloader, monitor, resume):
             state["step_count"],
             flops_per_batch=estimated_flops,
             lengths=total_lengths,
-            train_loss = loss.item()
+            train_loss = loss.item(),
+            data_elapsed=data_time,
         )
+        if not global_shuffle and state["iter_num"] % log_iter_interval == 0:
+            token_counts = train_dataloader.dataset.token_counts(
+                state["iter_num"] - initial_iter + replayed_iters, micro_batch_size, train_dataloader.num_workers
+            )
+            fabric.log_dict(
+                {f"data/device/tokens/{prefix}": int(n) for (prefix, _), n in zip(train_data_config, token_counts)},
+                state["step_count"],
+            )
 
             
             
             
-        if val_dataloader is not None and not is_accumulating and state["step_count"] % eval_step_interval == 0:
+        # a subset of the validation set every `eval_step_interval` steps, the full set at checkpoints
+        full_eval = state["step_count"] % save_step_interval == 0
+        if val_set is not None and not is_accumulating and (state["step_count"] % eval_step_interval == 0 or full_eval):
             
             t0 = time.perf_counter()
-            val_loss = validate(fabric, model, val_dataloader)
+            val_loss = validate(fabric, model, val_set, None if full_eval else eval_subset_iters).item()
             t1 = time.perf_counter() - t0
             monitor.eval_end(t1)
-            fabric.print(f"step {state['iter_num']}: val loss {val_loss:.4f}, val time: {t1 * 1000:.2f}ms")
-            fabric.log_dict({"metric/val_loss": val_loss.item(), "total_tokens": model.config.block_size * (state["iter_num"] + 1) * micro_batch_size * fabric.world_size}, state["step_count"])
-            fabric.log_dict({"metric/val_ppl": math.exp(val_loss.item()), "total_tokens": model.config.block_size * (state["iter_num"] + 1) * micro_batch_size * fabric.world_size}, state["step_count"])
+            metric = "metric/full_val" if full_eval else "metric/val"
+            fabric.print(f"step {state['iter_num']}: {metric} loss {val_loss:.4f}, val time: {t1 * 1000:.2f}ms")
+            fabric.log_dict({f"{metric}_loss": val_loss, "total_tokens": model.config.block_size * (state["iter_num"] + 1) * micro_batch_size * fabric.world_size}, state["step_count"])
+            fabric.log_dict({f"{metric}_ppl": math.exp(val_loss), "total_tokens": model.config.block_size * (state["iter_num"] + 1) * micro_batch_size * fabric.world_size}, state["step_count"])
             fabric.barrier()
         if not is_accumulating and state["step_count"] % save_step_interval == 0:
             checkpoint_path = out_dir / f"iter-{state['iter_num']:06d}-ckpt.pth"
             fabric.print(f"Saving checkpoint to {str(checkpoint_path)!r}")
+            state["train_data"] = data_state_dict(fabric, train_dataloader, state["iter_num"] - initial_iter + replayed_iters)
             fabric.save(checkpoint_path, state)
+        data_t0 = time.perf_counter()
 
         
-@torch.no_grad()
-def validate(fabric: L.Fabric, model: torch.nn.Module, val_dataloader: DataLoader) -> torch.Tensor:
+def validate(fabric: L.Fabric, model: torch.nn.Module, val_set: ValidationSet, n_batches: Optional[int]) -> torch.Tensor:
     fabric.print("Validating ...")
     model.eval()
-
-    losses = torch.zeros(eval_iters, device=fabric.device)
-    for k, val_data in enumerate(val_dataloader):
-        if k >= eval_iters:
-            break
-        input_ids = val_data[:, 0 : model.config.block_size].contiguous()
-        targets = val_data[:, 1 : model.config.block_size + 1].contiguous()
-        logits = model(input_ids)
-        loss = chunked_cross_entropy(logits, targets, chunk_size=0)
-
-        # loss_func = FusedCrossEntropyLoss()
-        # loss = loss_func(logits, targets)
-        losses[k] = loss.item()
-        
-    out = losses.mean()
-
+    # the mean loss over the first `n_batches` batches (all if None) of every rank
+    out = val_set.evaluate(model, n_batches)
     model.train()
     return out
 
 
+def data_source(train_dataloader: DataLoader):
+    """Return the object that holds the position of the training data, the sampler when shuffling globally."""
+    return train_dataloader.sampler if global_shuffle else train_dataloader.dataset
+
+
+def data_state_dict(fabric: L.Fabric, train_dataloader: DataLoader, num_batches: int) -> list:
+    """Collect the state of the training data iterators of every rank."""
+    data_state = data_source(train_dataloader).state_dict(num_batches, micro_batch_size, train_dataloader.num_workers)
+    if fabric.world_size == 1:
+        return [data_state]
+    data_states = [None] * fabric.world_size
+    torch.distributed.all_gather_object(data_states, data_state)
+    return data_states
+
+
 def create_dataloader(
     batch_size: int, block_size: int, data_dir: Path, fabric, shuffle: bool = True, seed: int = 12345, split="train"
 ) -> DataLoader:
     datasets = []
+    weights = []
     data_config = train_data_config if split == "train" else val_data_config
-    for prefix, _ in data_config:
-        filenames = sorted(glob.glob(str(data_dir / f"{prefix}*")))
+    chunk_cache = None
+    if chunk_cache_dir is not None:
+        # the chunks of a remote data directory are listed by its manifest and fetched into the cache
+        chunk_cache = ChunkCache(data_dir, Path(chunk_cache_dir) / split, chunk_cache_bytes)
+        manifest = chunk_cache.open(MANIFEST_NAME, np.load)
+    else:
+        manifest = load_manifest(data_dir)
+    if split == "train" and global_shuffle:
+        if chunk_cache is not None:
+            raise ValueError("Global shuffling reads all chunks at random, it can't read them through the cache.")
+        return create_global_shuffle_dataloader(batch_size, block_size, data_dir, manifest, fabric, seed)
+    for prefix, weight in data_config:
+        if manifest is not None:
+            entries = select_manifest(manifest, prefix)
+            filenames = [str(data_dir / name) for name in entries["filename"].astype(str)]
+            dtype = dtypes[int(entries["dtype"][0])] if len(entries) else None
+            chunk_size = int(entries["chunk_size"][0]) if len(entries) else None
+            n_tokens = int(entries["n_tokens"].sum())
+        else:
+            # no manifest: glob the directory and let the iterators read the chunk headers
+            filenames = sorted(glob.glob(str(data_dir / f"{prefix}*.bin")))
+            dtype = chunk_size = None
+            # the chunk sizes, padding included
+            n_tokens = sum(read_header(filename)[1] for filename in filenames)
+            if weight is None:
+                fabric.print(
+                    f"Warning: {data_dir} has no manifest, weighting {prefix!r} by the size of its chunks including"
+                    " padding. Run scripts/build_manifest.py to weight it by its tokens."
+                )
         random.seed(seed)
         random.shuffle(filenames)
 
@@ -323,21 +403,82 @@ def create_dataloader(
             seed=seed+fabric.global_rank,
             num_processes=fabric.world_size,
             process_rank=fabric.global_rank,
+            dtype=dtype,
+            chunk_size=chunk_size,
+            # open and warm the next window of chunks in the background
+            prefetch=True,
+            chunk_cache=chunk_cache,
         )
         datasets.append(dataset)
+        weights.append(n_tokens if weight is None else weight)
 
     if not datasets:
         raise RuntimeError(
             f"No data found at {data_dir}. Make sure you ran prepare_redpajama.py to create the dataset."
         )
 
-    weights = [weight for _, weight in data_config]
     sum_weights = sum(weights)
     weights = [el / sum_weights for el in weights]
+    fabric.print(f"{split} data mixture: {dict(zip([prefix for prefix, _ in data_config], weights))}")
+
+    # gather whole micro-batches in the token dtype of the chunks, they are widened on the device with `to_token_ids`
+    combined_dataset = CombinedDataset(
+        datasets=datasets, seed=seed, weights=weights, batch_size=batch_size, pin_memory=True
+    )
+
+    return DataLoader(combined_dataset, batch_size=None, shuffle=False, pin_memory=True)
+
+
+def create_global_shuffle_dataloader(batch_size: int, block_size: int, data_dir: Path, manifest, fabric, seed: int):
+    if manifest is None:
+        raise RuntimeError(f"Global shuffling needs the manifest of {data_dir}. Run scripts/build_manifest.py first.")
+    if any(weight is not None for _, weight in train_data_config):
+        raise ValueError("Global shuffling samples every block once per epoch, the datasets can't be weighted.")
+    entries = np.concatenate([select_manifest(manifest, prefix) for prefix, _ in train_data_config])
+    if not len(entries):
+        raise RuntimeError(
+            f"No data found at {data_dir}. Make sure you ran prepare_redpajama.py to create the dataset."
+        )
+    dataset = PackedBlockDataset(
+        [str(data_dir / name) for name in entries["filename"].astype(str)],
+        block_size=block_size,
+        dtype=dtypes[int(entries["dtype"][0])],
+        chunk_sizes=entries["chunk_size"],
+    )
+    fabric.print(f"train data: {len(dataset)} blocks shuffled globally")
+    sampler = GlobalShuffleSampler(
+        len(dataset), seed=seed, num_processes=fabric.world_size, process_rank=fabric.global_rank
+    )
+    return DataLoader(dataset, batch_size=batch_size, sampler=sampler, pin_memory=True)
 
-    combined_dataset = CombinedDataset(datasets=datasets, seed=seed, weights=weights)
 
-    return DataLoader(combined_dataset, batch_size=batch_size, shuffle=False, pin_memory=True)
+def create_validation_set(batch_size: int, block_size: int, data_dir: Path, fabric) -> ValidationSet:
+    chunk_cache = None
+    if chunk_cache_dir is not None:
+        chunk_cache = ChunkCache(data_dir, Path(chunk_cache_dir) / "validation", chunk_cache_bytes)
+        manifest = chunk_cache.open(MANIFEST_NAME, np.load)
+    else:
+        manifest = load_manifest(data_dir)
+    filenames = []
+    for prefix, _ in val_data_config:
+        if manifest is not None:
+            filenames += [str(data_dir / name) for name in select_manifest(manifest, prefix)["filename"].astype(str)]
+        else:
+            filenames += sorted(glob.glob(str(data_dir / f"{prefix}*.bin")))
+    if not filenames:
+        raise RuntimeError(f"No validation data found at {data_dir}.")
+    val_set = ValidationSet(
+        filenames,
+        block_size=block_size,
+        batch_size=batch_size,
+        max_batches=eval_iters,
+        device=fabric.device,
+        num_processes=fabric.world_size,
+        process_rank=fabric.global_rank,
+        chunk_cache=chunk_cache,
+    )
+    fabric.print(f"validation data: {val_set.n_batches} batches per device")
+    return val_set
 
 
 def create_dataloaders(
@@ -347,7 +488,7 @@ def create_dataloaders(
     train_data_dir: Path = Path("data/redpajama_sample"),
     val_data_dir: Optional[Path] = None,
     seed: int = 12345,
-) -> Tuple[DataLoader, DataLoader]:
+) -> Tuple[DataLoader, Optional[ValidationSet]]:
     # Increase by one because we need the next word as well
     effective_block_size = block_size + 1
     train_dataloader = create_dataloader(
@@ -359,20 +500,12 @@ def create_dataloaders(
         seed=seed,
         split="train"
     )
-    val_dataloader = (
-        create_dataloader(
-            batch_size=batch_size,
-            block_size=effective_block_size,
-            fabric=fabric,
-            data_dir=val_data_dir,
-            shuffle=False,
-            seed=seed,
-            split="validation"
-        )
+    val_set = (
+        create_validation_set(batch_size=batch_size, block_size=effective_block_size, data_dir=val_data_dir, fabric=fabric)
         if val_data_dir
         else None
     )
-    return train_dataloader, val_dataloader
+    return train_dataloader, val_set
 
 
 # learning rate decay scheduler (cosine with warmup)
@@ -0,0 +1,25 @@
+import sys
+from pathlib import Path
+from typing import Optional
+
+# support running without installing as a package
+wd = Path(__file__).parent.parent.resolve()
+sys.path.append(str(wd))
+
+import lit_gpt.packed_dataset as packed_dataset
+
+
+def build(data_dir: Path = Path("data/slim_star_combined"), sep_token: Optional[int] = 1) -> None:
+    """Index a directory of packed chunks that was prepared before the prepare scripts wrote manifests.
+
+    `sep_token` is the separator the chunks were built with (the tokenizer's BOS for SlimPajama and StarCoder).
+    Pass None to index the headers only, which skips reading the chunk contents.
+    """
+    manifest = packed_dataset.build_manifest(data_dir, sep_token=sep_token)
+    print(f"Indexed {len(manifest)} chunks, {int(manifest['n_tokens'].sum())} tokens in {data_dir}")
+
+
+if __name__ == "__main__":
+    from jsonargparse import CLI
+
+    CLI(build)
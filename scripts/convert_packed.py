@@ -0,0 +1,62 @@
+import glob
+import os
+import shutil
+import sys
+import time
+from functools import partial
+from multiprocessing import Pool, cpu_count
+from pathlib import Path
+from typing import Optional
+
+# support running without installing as a package
+wd = Path(__file__).parent.parent.resolve()
+sys.path.append(str(wd))
+
+import lit_gpt.packed_dataset as packed_dataset
+
+
+def convert(
+    source_path: Path = Path("data/slim_star_combined"),
+    destination_path: Path = Path("data/slim_star_combined_zstd"),
+    codec: Optional[str] = "zstd",
+    frame_size: int = packed_dataset.DEFAULT_FRAME_SIZE,
+    level: int = 3,
+    num_processes: Optional[int] = None,
+) -> None:
+    """Convert a directory of packed chunks to the compressed version 2 format, or back to version 1 if `codec` is
+    None. The manifest and the document indexes are copied along, chunks that already exist are skipped."""
+    destination_path.mkdir(parents=True, exist_ok=True)
+    filenames = sorted(glob.glob(str(source_path / "*.bin")))
+    todo = [name for name in filenames if not (destination_path / os.path.basename(name)).exists()]
+    print(f"Converting {len(todo)} of {len(filenames)} chunks to {codec or 'uncompressed'}")
+
+    start_time = time.time()
+    convert_chunk = partial(
+        _convert_chunk, destination_path=destination_path, codec=codec, frame_size=frame_size, level=level
+    )
+    src_bytes = dst_bytes = 0
+    with Pool(num_processes or cpu_count()) as pool:
+        for i, (src_size, dst_size) in enumerate(pool.imap_unordered(convert_chunk, todo), 1):
+            src_bytes += src_size
+            dst_bytes += dst_size
+            if i % 100 == 0 or i == len(todo):
+                print(f"{i}/{len(todo)} chunks, {src_bytes / 1e9:.2f} GB -> {dst_bytes / 1e9:.2f} GB")
+
+    for name in glob.glob(str(source_path / f"*{packed_dataset.DOC_INDEX_SUFFIX}")):
+        shutil.copy(name, destination_path)
+    manifest_path = source_path / packed_dataset.MANIFEST_NAME
+    if manifest_path.exists():
+        # the manifest describes the tokens of the chunks, which are the same in both formats
+        shutil.copy(manifest_path, destination_path)
+    print(f"Time taken: {time.time() - start_time:.2f} seconds")
+
+
+def _convert_chunk(filename, destination_path, codec, frame_size, level):
+    dst = str(destination_path / os.path.basename(filename))
+    return packed_dataset.convert_chunk(filename, dst, codec=codec, frame_size=frame_size, level=level)
+
+
+if __name__ == "__main__":
+    from jsonargparse import CLI
+
+    CLI(convert)
@@ -0,0 +1,216 @@
+import glob
+import json
+import os
+import re
+import sys
+import time
+from collections import defaultdict
+from functools import partial
+from multiprocessing import Pool, cpu_count
+from pathlib import Path
+from typing import List, Optional
+
+import numpy as np
+
+# support running without installing as a package
+wd = Path(__file__).parent.parent.resolve()
+sys.path.append(str(wd))
+
+import lit_gpt.packed_dataset as packed_dataset
+
+SLICE_SIZE = 1 << 24  # tokens counted at once
+
+
+def stats(
+    data_dir: Path = Path("data/slim_star_combined"),
+    output: Path = Path("data/slim_star_combined_stats.json"),
+    prefixes: Optional[List[str]] = None,
+    sep_token: int = 1,
+    vocab_size: Optional[int] = 32000,
+    max_sep_fraction: float = 0.05,
+    num_processes: Optional[int] = None,
+) -> None:
+    """Scan the packed chunks of `data_dir` and write per-chunk and per-prefix statistics to `output`.
+
+    The chunks are summarized per prefix in `prefixes`, or per builder prefix: the name without the counter, and
+    without the source key or `_tails` of the chunks written by `lit_gpt.prepare_pipeline`. The token histograms of
+    the prefixes are saved next to `output` as an `.npz` file. A chunk is flagged if its header or size is invalid or
+    differs from the other chunks of its prefix, if it has tokens outside of `vocab_size`, if more than
+    `max_sep_fraction` of its tokens before the padding are `sep_token`, if it is padded but is not the last chunk of
+    its prefix, or if its manifest entry or document index don't match its contents.
+    """
+    filenames = sorted(glob.glob(str(data_dir / "*.bin")))
+    manifest = packed_dataset.load_manifest(data_dir)
+    entries = {} if manifest is None else {entry["filename"].decode(): entry for entry in manifest}
+    print(f"Scanning {len(filenames)} chunks in {data_dir}")
+
+    start_time = time.time()
+    scan = partial(_scan_chunk, sep_token=sep_token, vocab_size=vocab_size)
+    chunks = []
+    histograms = defaultdict(lambda: np.zeros(0, dtype=np.int64))
+    with Pool(num_processes or cpu_count()) as pool:
+        for i, (chunk, histogram) in enumerate(pool.imap(scan, filenames, chunksize=4), 1):
+            chunk["prefix"] = _prefix_of(chunk["filename"], prefixes)
+            _check_chunk(chunk, entries.get(chunk["filename"]), vocab_size, max_sep_fraction)
+            chunks.append(chunk)
+            if chunk["prefix"] is not None and histogram is not None:
+                total = histograms[chunk["prefix"]]
+                if len(total) < len(histogram):
+                    total = np.pad(total, (0, len(histogram) - len(total)))
+                total[: len(histogram)] += histogram
+                histograms[chunk["prefix"]] = total
+            if i % 100 == 0 or i == len(filenames):
+                print(f"{i}/{len(filenames)} chunks, {time.time() - start_time:.1f} seconds")
+
+    summaries = {}
+    for prefix in sorted({chunk["prefix"] for chunk in chunks if chunk["prefix"] is not None}):
+        summaries[prefix] = _summarize([chunk for chunk in chunks if chunk["prefix"] == prefix], histograms[prefix])
+    anomalies = [{"filename": chunk["filename"], "issues": chunk["issues"]} for chunk in chunks if chunk["issues"]]
+
+    output.parent.mkdir(parents=True, exist_ok=True)
+    with open(output, "w") as f:
+        json.dump({"data_dir": str(data_dir), "prefixes": summaries, "chunks": chunks, "anomalies": anomalies}, f)
+    np.savez(output.with_suffix(".npz"), **histograms)
+
+    for prefix, summary in summaries.items():
+        print(
+            f"{prefix}: {summary['n_chunks']} chunks, {summary['n_tokens']:,} tokens, {summary['n_docs']:,} documents,"
+            f" {summary['sep_fraction']:.4%} separators, {summary['padding_fraction']:.4%} padding"
+        )
+    print(f"{len(anomalies)} anomalous chunks, see {output}")
+    for anomaly in anomalies[:20]:
+        print(f"  {anomaly['filename']}: {'; '.join(anomaly['issues'])}")
+    print(f"Time taken: {time.time() - start_time:.2f} seconds")
+
+
+def _prefix_of(filename, prefixes):
+    if prefixes is None:
+        # `{prefix}_{counter}.bin`, or `{prefix}_{source key}_{counter}.bin` and `{prefix}_tails_{counter}.bin`
+        return re.sub(r"(_[0-9a-f]{16}|_tails)?_\d+\.bin$", "", filename)
+    return next((prefix for prefix in prefixes if filename.startswith(prefix)), None)
+
+
+def _scan_chunk(path, sep_token, vocab_size):
+    filename = os.path.basename(path)
+    chunk = {"filename": filename, "file_size": os.path.getsize(path), "issues": []}
+    try:
+        dtype, chunk_size = packed_dataset.read_header(path)
+        tokens = packed_dataset.open_chunk(path)
+    except Exception as e:
+        chunk["issues"].append(f"unreadable header: {e!r}")
+        return chunk, None
+    chunk["dtype"] = np.dtype(dtype).name
+    chunk["chunk_size"] = int(chunk_size)
+    compressed = isinstance(tokens, packed_dataset.CompressedChunk)
+    chunk["version"] = 2 if compressed else 1
+    if not compressed and chunk["file_size"] != packed_dataset.HDR_SIZE + chunk_size * np.dtype(dtype).itemsize:
+        chunk["issues"].append(f"file size {chunk['file_size']} does not match the header")
+        packed_dataset.close_chunk(tokens)
+        return chunk, None
+
+    minlength = vocab_size or 0
+    histogram = np.zeros(minlength, dtype=np.int64)
+    max_token = -1
+    trailing_sep = 0  # length of the run of `sep_token` at the end, the padding
+    try:
+        for start in range(0, chunk_size, SLICE_SIZE):
+            stop = min(start + SLICE_SIZE, chunk_size)
+            arr = tokens.read(start, stop) if compressed else tokens[start:stop]
+            if np.issubdtype(arr.dtype, np.signedinteger) and len(arr) and arr.min() < 0:
+                chunk["issues"].append("negative tokens")
+                arr = arr[arr >= 0]
+            counts = np.bincount(arr, minlength=minlength)
+            if len(counts) > len(histogram):
+                histogram = np.pad(histogram, (0, len(counts) - len(histogram)))
+            histogram[: len(counts)] += counts
+            if len(arr):
+                max_token = max(max_token, int(np.flatnonzero(counts)[-1]))
+            if len(arr) and arr[-1] == sep_token:
+                not_sep = np.flatnonzero(arr != sep_token)
+                trailing_sep = len(arr) - 1 - int(not_sep[-1]) if len(not_sep) else trailing_sep + len(arr)
+            elif len(arr):
+                trailing_sep = 0
+        n_sep = int(histogram[sep_token]) if sep_token < len(histogram) else 0
+    except Exception as e:
+        chunk["issues"].append(f"unreadable tokens: {e!r}")
+        return chunk, None
+    finally:
+        packed_dataset.close_chunk(tokens)
+
+    chunk["n_sep"] = n_sep
+    chunk["trailing_sep"] = trailing_sep
+    chunk["max_token"] = max_token
+    doc_index_path = packed_dataset.doc_index_path(path)
+    if os.path.isfile(doc_index_path):
+        try:
+            doc_starts, _ = packed_dataset.read_doc_index(path)
+            chunk["n_docs"] = len(doc_starts)
+            if len(doc_starts) and (np.any(np.diff(doc_starts) < 0) or doc_starts[-1] >= chunk_size):
+                chunk["issues"].append("document index offsets are not increasing or exceed the chunk")
+        except Exception as e:
+            chunk["issues"].append(f"unreadable document index: {e!r}")
+    return chunk, histogram
+
+
+def _check_chunk(chunk, entry, vocab_size, max_sep_fraction):
+    if "n_sep" not in chunk:
+        return  # unreadable
+    issues = chunk["issues"]
+    if entry is not None:
+        chunk["n_tokens"] = int(entry["n_tokens"])
+        if int(entry["chunk_size"]) != chunk["chunk_size"] or packed_dataset.dtypes[int(entry["dtype"])] != np.dtype(
+            chunk["dtype"]
+        ):
+            issues.append("header does not match the manifest")
+        if int(entry["n_sep"]) != chunk["n_sep"]:
+            issues.append(f"{chunk['n_sep']} separators, the manifest counts {int(entry['n_sep'])}")
+        if "n_docs" in chunk and int(entry["n_docs"]) != chunk["n_docs"]:
+            issues.append(f"{chunk['n_docs']} documents, the manifest counts {int(entry['n_docs'])}")
+    else:
+        # without a manifest, the trailing separators are taken for padding
+        chunk["n_tokens"] = chunk["chunk_size"] - chunk["trailing_sep"]
+    if chunk["n_tokens"] == 0:
+        issues.append("no tokens")
+    if vocab_size is not None and chunk["max_token"] >= vocab_size:
+        issues.append(f"token {chunk['max_token']} is outside of the vocabulary of {vocab_size}")
+    padding = chunk["chunk_size"] - chunk["n_tokens"]
+    sep_fraction = (chunk["n_sep"] - padding) / max(chunk["n_tokens"], 1)
+    chunk["sep_fraction"] = sep_fraction
+    if sep_fraction > max_sep_fraction:
+        issues.append(f"{sep_fraction:.2%} of the tokens are separators")
+
+
+def _summarize(chunks, histogram):
+    readable = [chunk for chunk in chunks if "n_sep" in chunk]
+    n_tokens = sum(chunk["n_tokens"] for chunk in readable)
+    chunk_size = sum(chunk["chunk_size"] for chunk in readable)
+    n_padding = chunk_size - n_tokens
+    headers = {(chunk["dtype"], chunk["chunk_size"]) for chunk in readable}
+    if len(headers) > 1:
+        # the loaders need the same dtype and chunk size for all chunks of a prefix
+        for chunk in readable:
+            chunk["issues"].append(f"headers of the prefix differ: {sorted(headers)}")
+    for chunk in readable[:-1]:
+        # builders only pad the last chunk they write
+        if chunk["n_tokens"] < chunk["chunk_size"]:
+            chunk["issues"].append(f"{chunk['chunk_size'] - chunk['n_tokens']} tokens of padding before the last chunk")
+    top = np.argsort(histogram)[::-1][:20]
+    return {
+        "n_chunks": len(chunks),
+        "n_unreadable": len(chunks) - len(readable),
+        "n_tokens": n_tokens,
+        "n_docs": sum(chunk.get("n_docs", 0) for chunk in readable),
+        "n_bytes": sum(chunk["file_size"] for chunk in chunks),
+        "headers": [{"dtype": dtype, "chunk_size": size} for dtype, size in sorted(headers)],
+        "sep_fraction": (sum(chunk["n_sep"] for chunk in readable) - n_padding) / max(n_tokens, 1),
+        "padding_fraction": n_padding / max(chunk_size, 1),
+        "max_token": max((chunk["max_token"] for chunk in readable), default=-1),
+        "unused_tokens": int(np.count_nonzero(histogram == 0)),
+        "top_tokens": [[int(token), int(histogram[token])] for token in top if histogram[token]],
+    }
+
+
+if __name__ == "__main__":
+    from jsonargparse import CLI
+
+    CLI(stats)
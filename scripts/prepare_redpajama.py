@@ -2,9 +2,9 @@ import glob
 import json
 import os
 import sys
+from itertools import islice
 from pathlib import Path
 
-import numpy as np
 from tqdm import tqdm
 
 # support running without installing as a package
@@ -39,6 +39,12 @@ filename_sets = {
 }
 
 
+def batched(rows, batch_size=1024):
+    rows = iter(rows)
+    while batch := list(islice(rows, batch_size)):
+        yield batch
+
+
 def prepare_sample(
     source_path: Path, checkpoint_dir: Path, destination_path: Path, chunk_size: int, match: str = ""
 ) -> None:
@@ -75,12 +81,13 @@ def prepare_sample(
         print(f"Processing {name}")
 
         with open(filepath, encoding="utf-8") as f:
-            for row in tqdm(f):
-                text = json.loads(row)["text"]
-                text_ids = tokenizer.encode(text)
-                builder.add_array(np.array(text_ids, dtype=builder.dtype))
+            for rows in batched(tqdm(f)):
+                texts = [json.loads(row)["text"] for row in rows]
+                for text_ids in tokenizer.encode_batch(texts, dtype=builder.dtype):
+                    builder.add_array(text_ids)
 
         builder.write_reminder()
+        builder.write_manifest()
 
 
 def prepare_full(
@@ -125,18 +132,19 @@ def prepare_full(
 
             if is_cc:
                 with zstd.open(open(filepath, "rb"), "rt", encoding="utf-8") as f:
-                    for row in tqdm(f):
-                        text = json.loads(row)["text"]
-                        text_ids = tokenizer.encode(text)
-                        builder.add_array(np.array(text_ids, dtype=builder.dtype))
+                    for rows in batched(tqdm(f)):
+                        texts = [json.loads(row)["text"] for row in rows]
+                        for text_ids in tokenizer.encode_batch(texts, dtype=builder.dtype):
+                            builder.add_array(text_ids)
             else:
                 with open(filepath, encoding="utf-8") as f:
-                    for row in tqdm(f):
-                        text = json.loads(row)["text"]
-                        text_ids = tokenizer.encode(text)
-                        builder.add_array(np.array(text_ids, dtype=builder.dtype))
+                    for rows in batched(tqdm(f)):
+                        texts = [json.loads(row)["text"] for row in rows]
+                        for text_ids in tokenizer.encode_batch(texts, dtype=builder.dtype):
+                            builder.add_array(text_ids)
 
         builder.write_reminder()
+        builder.write_manifest()
 
 
 def prepare(
@@ -158,6 +166,7 @@ def prepare(
         chunk_size=(config.block_size + 1) * 1024,  # block size + 1 for causal, 1024 blocks
         match=match,
     )
+    packed_dataset.build_manifest(destination_path)
 
 
 if __name__ == "__main__":
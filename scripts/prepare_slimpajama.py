@@ -3,17 +3,13 @@ import glob
 import os
 from pathlib import Path
 import sys
-from typing import List
-import numpy as np
-from tqdm import tqdm
-from multiprocessing import Process, cpu_count
+from typing import Optional
 
 # support running without installing as a package
 wd = Path(__file__).parent.parent.resolve()
 sys.path.append(str(wd))
 
-import lit_gpt.packed_dataset as packed_dataset
-from lit_gpt import Tokenizer
+from lit_gpt.prepare_pipeline import prepare_packed
 
 # Filename for SlimPajama
 slimpajama_sets = {
@@ -22,52 +18,31 @@ slimpajama_sets = {
     "test": "test/chunk*/*",
 }
 
+# The RedPajama subset of each document, its index is stored as the source id in the document index of the chunks
+redpajama_set_names = (
+    "RedPajamaCommonCrawl",
+    "RedPajamaC4",
+    "RedPajamaGithub",
+    "RedPajamaBook",
+    "RedPajamaArXiv",
+    "RedPajamaWikipedia",
+    "RedPajamaStackExchange",
+)
 
-def prepare_full(
-    source_path: Path,
-    tokenizer_path: Path,
-    destination_path: Path,
-    chunk_size: int,
-    split: str="train",
-    filenames_subset: List[str] = None,
-    process_id: int = 0
-) -> None:
-    import zstandard as zstd
 
-    destination_path.mkdir(parents=True, exist_ok=True)
-
-    tokenizer = Tokenizer(tokenizer_path)
-
-    # Use the provided filenames_subset or default to all filenames
-    filenames = filenames_subset 
-    
-    if not filenames:
-        raise RuntimeError(
-            f"No files matching {slimpajama_sets[split]} found at {source_path}. \n"
-            "Make sure you download the data..."
-        )
+def read_jsonl_zst(filepath: str):
+    import zstandard as zstd
 
-    builder = packed_dataset.PackedDatasetBuilder(
-        outdir=destination_path,
-        prefix=f"{split}_slimpajama_{process_id}",  # Use process_id to differentiate builders
-        chunk_size=chunk_size,
-        sep_token=tokenizer.bos_id,
-        dtype="auto",
-        vocab_size=tokenizer.vocab_size,
-    )
+    with zstd.open(open(filepath, "rb"), "rt", encoding="utf-8") as f:
+        yield from f
 
-    for filepath in filenames:
-        print(f"Processing {filepath}")
-        with zstd.open(open(filepath, "rb"), "rt", encoding="utf-8") as f:
-            for row in tqdm(f):
-                text = json.loads(row)["text"]
-                if json.loads(row)["meta"]["redpajama_set_name"] == "RedPajamaGithub":
-                    continue # we don't want to include the github data
-                text_ids = tokenizer.encode(text)
-                builder.add_array(np.array(text_ids, dtype=builder.dtype))
 
-    # we throw away the final corpus to avoid meaningless corpus filled with bos_ids, see https://github.com/jzhang38/TinyLlama/issues/83 for more details
-    # builder.write_reminder()
+def parse_row(row: str):
+    row = json.loads(row)
+    set_name = row["meta"]["redpajama_set_name"]
+    if set_name == "RedPajamaGithub":
+        return None  # we don't want to include the github data
+    return row["text"], redpajama_set_names.index(set_name)
 
 
 def prepare(
@@ -77,25 +52,39 @@ def prepare(
     chunk_size: int = 2049 * 1024,
     split: str="train",
     percentage: float = 1.0,
+    num_readers: int = 8,
+    num_workers: Optional[int] = None,
+    num_writers: int = 4,
+    dedup: bool = False,
+    dedup_capacity: int = 1 << 20,
 ) -> None:
     import time
 
     filenames = glob.glob(os.path.join(source_path, slimpajama_sets[split]), recursive=True)
     filenames = filenames[:int(len(filenames) * percentage)]
-    
-    num_processes = cpu_count() 
-    chunked_filenames = np.array_split(filenames, num_processes)
+    if not filenames:
+        raise RuntimeError(
+            f"No files matching {slimpajama_sets[split]} found at {source_path}. \n"
+            "Make sure you download the data..."
+        )
 
-    processes = []
     start_time = time.time()
-
-    for i, subset in enumerate(chunked_filenames):
-        p = Process(target=prepare_full, args=(source_path, tokenizer_path, destination_path, chunk_size, split, list(subset), i))
-        processes.append(p)
-        p.start()
-
-    for p in processes:
-        p.join()
+    prepare_packed(
+        filenames,
+        read=read_jsonl_zst,
+        parse=parse_row,
+        tokenizer_path=tokenizer_path,
+        source_path=source_path,
+        destination_path=destination_path,
+        prefix=f"{split}_slimpajama",
+        chunk_size=chunk_size,
+        num_readers=num_readers,
+        num_workers=num_workers,
+        num_writers=num_writers,
+        dedup=dedup,
+        dedup_capacity=dedup_capacity,
+        source_names=list(redpajama_set_names),
+    )
     end_time = time.time()
     elapsed_time = end_time - start_time
     print(f"Time taken: {elapsed_time:.2f} seconds")
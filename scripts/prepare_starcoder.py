@@ -1,69 +1,43 @@
-import json
 import glob
 import os
 from pathlib import Path
 import sys
-from typing import List
-import numpy as np
-from tqdm import tqdm
-from multiprocessing import Process, cpu_count
+from typing import List, Optional
 
 # support running without installing as a package
 wd = Path(__file__).parent.parent.resolve()
 sys.path.append(str(wd))
 
-import lit_gpt.packed_dataset as packed_dataset
-from lit_gpt import Tokenizer
+from lit_gpt.prepare_pipeline import prepare_packed
 
-import pandas as pd
 
+def read_parquet(filepath: str, batch_size: int = 1024):
+    """Stream the `content` column of a parquet file in record batches, so memory stays bounded by a batch.
 
-def prepare_full(
-    source_path: Path,
-    tokenizer_path: Path,
-    destination_path: Path,
-    chunk_size: int,
-    split: str="train",
-    filenames_subset: List[str] = None,
-    process_id: int = 0
-) -> None:
-    import zstandard as zstd
-
-    destination_path.mkdir(parents=True, exist_ok=True)
-
-    tokenizer = Tokenizer(tokenizer_path)
-
-    # Use the provided filenames_subset or default to all filenames
-    filenames = filenames_subset 
-    
-    if not filenames:
-        raise RuntimeError(
-            f"No files matching  found at {source_path}. \n"
-            "Make sure you download the data..."
-        )
-
-    builder = packed_dataset.PackedDatasetBuilder(
-        outdir=destination_path,
-        prefix=f"{split}_starcoder_{process_id}",  # Use process_id to differentiate builders
-        chunk_size=chunk_size,
-        sep_token=tokenizer.bos_id,
-        dtype="auto",
-        vocab_size=tokenizer.vocab_size,
-    )
+    Row groups that can't be decoded are reported with their row range and skipped.
+    """
+    import pyarrow.parquet as pq
 
-    for filepath in filenames:
-        print(f"Processing {filepath}")
+    try:
+        parquet_file = pq.ParquetFile(filepath)
+    except Exception as e:
+        print(f"Error reading {filepath}, skipping the whole file: {e!r}")
+        return
+    start = 0
+    for row_group in range(parquet_file.num_row_groups):
+        end = start + parquet_file.metadata.row_group(row_group).num_rows
+        row = start
         try:
-            contents = pd.read_parquet(filepath, engine='pyarrow')['content']
-        except:
-            print(f"Error reading {filepath}!!")
-            continue
-        for text in contents:
-            text_ids = tokenizer.encode(text)
-            builder.add_array(np.array(text_ids, dtype=builder.dtype))
+            for batch in parquet_file.iter_batches(batch_size, row_groups=[row_group], columns=["content"]):
+                yield from batch.column(0).to_pylist()
+                row += batch.num_rows
+        except Exception as e:
+            print(f"Error reading {filepath}, skipping rows {row}-{end}: {e!r}")
+        start = end
+
 
-    # we throw away the final corpus to avoid meaningless corpus filled with bos_ids, see https://github.com/jzhang38/TinyLlama/issues/83 for more details
-    # builder.write_reminder()
+def parse_content(text: str):
+    return text, 0
 
 
 def prepare(
@@ -74,6 +48,11 @@ def prepare(
     split: str="train",
     percentage: float = 1.0,
     filenames_subset: List[str] = None,
+    num_readers: int = 8,
+    num_workers: Optional[int] = None,
+    num_writers: int = 4,
+    dedup: bool = False,
+    dedup_capacity: int = 1 << 20,
 ) -> None:
     import time
     assert split == "train" #  starcoder only has train data
@@ -82,19 +61,29 @@ def prepare(
     if filenames_subset:
         filenames = [f for f in filenames if any([prefix in f for prefix in filenames_subset])]
     filenames = filenames[:int(len(filenames) * percentage)]
-    num_processes = 64
-    chunked_filenames = np.array_split(filenames, num_processes)
+    if not filenames:
+        raise RuntimeError(
+            f"No files matching  found at {source_path}. \n"
+            "Make sure you download the data..."
+        )
 
-    processes = []
     start_time = time.time()
-
-    for i, subset in enumerate(chunked_filenames):
-        p = Process(target=prepare_full, args=(source_path, tokenizer_path, destination_path, chunk_size, split, list(subset), i))
-        processes.append(p)
-        p.start()
-
-    for p in processes:
-        p.join()
+    prepare_packed(
+        filenames,
+        read=read_parquet,
+        parse=parse_content,
+        tokenizer_path=tokenizer_path,
+        source_path=source_path,
+        destination_path=destination_path,
+        prefix=f"{split}_starcoder",
+        chunk_size=chunk_size,
+        num_readers=num_readers,
+        num_workers=num_workers,
+        num_writers=num_writers,
+        dedup=dedup,
+        dedup_capacity=dedup_capacity,
+        source_names=["starcoder"],
+    )
     end_time = time.time()
     elapsed_time = end_time - start_time
     print(f"Time taken: {elapsed_time:.2f} seconds")
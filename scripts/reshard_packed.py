@@ -0,0 +1,146 @@
+import glob
+import math
+import os
+import sys
+import time
+from multiprocessing import Pool, cpu_count
+from pathlib import Path
+from typing import Optional, Tuple
+
+import numpy as np
+
+# support running without installing as a package
+wd = Path(__file__).parent.parent.resolve()
+sys.path.append(str(wd))
+
+import lit_gpt.packed_dataset as packed_dataset
+
+
+def reshard(
+    source_path: Path = Path("data/slim_star_combined"),
+    destination_path: Path = Path("data/slim_star_combined_8k"),
+    chunk_size: int = 8193 * 512,
+    prefixes: Tuple[str, ...] = ("train_slimpajama", "validation_slimpajama", "train_starcoder"),
+    num_chunks: Optional[int] = None,
+    block_size: int = 1,
+    dtype: Optional[str] = None,
+    codec: Optional[str] = None,
+    sep_token: int = 1,
+    drop_remainder: bool = False,
+    num_processes: Optional[int] = None,
+) -> None:
+    """Rewrite packed chunks into chunks of a different size or dtype, without tokenizing the corpus again.
+
+    The chunks of each prefix in `prefixes` are read in the order of their names, with their padding stripped, and
+    repacked into `{prefix}_{counter}.bin` chunks of `chunk_size` tokens. The documents stay in order and contiguous,
+    but like in the chunks written by the builder, a document may continue from one chunk into the next. Chunks
+    matching none of the prefixes are left out. With `num_chunks`, each prefix is instead split into that many chunks
+    of equal size. Chunk sizes must be a multiple of `block_size`, the `block_size + 1` the model trains with, so that
+    no block spans two chunks. The last chunk of a prefix is padded with `sep_token`, or dropped if `drop_remainder`.
+
+    Every output chunk is written by one process from ranges of the input chunks, so memory stays at about one chunk
+    per process. `source_path` needs a manifest, create it with `scripts/build_manifest.py` for older directories.
+    """
+    if destination_path.resolve() == source_path.resolve():
+        raise ValueError("The destination must be a different directory than the source.")
+    manifest = packed_dataset.load_manifest(source_path)
+    if manifest is None:
+        raise FileNotFoundError(f"{source_path} has no manifest, create it with scripts/build_manifest.py first.")
+    destination_path.mkdir(parents=True, exist_ok=True)
+
+    tasks = []
+    for prefix in prefixes:
+        entries = packed_dataset.select_manifest(manifest, prefix)
+        if not len(entries):
+            print(f"No chunks with prefix {prefix!r} in {source_path}")
+            continue
+        for path in glob.glob(str(destination_path / f"{prefix}_*")):
+            os.remove(path)
+        src_dtype = packed_dataset.dtypes[int(entries["dtype"][0])]
+        dst_dtype = src_dtype if dtype is None else np.dtype(dtype).type
+        n_tokens = entries["n_tokens"].astype(np.int64)
+        total = int(n_tokens.sum())
+        size = chunk_size
+        if num_chunks is not None:
+            size = math.ceil(math.ceil(total / num_chunks) / block_size) * block_size
+        if size % block_size:
+            raise ValueError(f"The chunk size {size} is not a multiple of the block size {block_size}.")
+        n_out = total // size if drop_remainder else math.ceil(total / size)
+        print(f"{prefix}: {len(entries)} chunks -> {n_out} chunks of {size} tokens, {total} tokens")
+
+        ends = np.cumsum(n_tokens)
+        starts = ends - n_tokens
+        for j in range(n_out):
+            start, stop = j * size, min((j + 1) * size, total)
+            first = int(np.searchsorted(ends, start, side="right"))
+            last = int(np.searchsorted(starts, stop, side="left"))
+            ranges = [
+                (
+                    str(source_path / entries["filename"][i].decode()),
+                    max(start - int(starts[i]), 0),
+                    min(stop, int(ends[i])) - int(starts[i]),
+                    max(int(starts[i]) - start, 0),
+                )
+                for i in range(first, last)
+            ]
+            filename = str(destination_path / f"{prefix}_{j:010d}.bin")
+            packed_dataset.check_manifest_filename(filename)
+            tasks.append((prefix, (filename, ranges, size, dst_dtype, codec, sep_token)))
+
+    start_time = time.time()
+    parts = {}
+    with Pool(num_processes or cpu_count()) as pool:
+        entries = pool.imap(_write_chunk, [task for _, task in tasks], chunksize=4)
+        for i, ((prefix, _), entry) in enumerate(zip(tasks, entries), 1):
+            parts.setdefault(prefix, []).append(entry)
+            if i % 100 == 0 or i == len(tasks):
+                print(f"{i}/{len(tasks)} chunks written")
+
+    for prefix, entries in parts.items():
+        path = destination_path / f"{prefix}{packed_dataset.MANIFEST_PART_SUFFIX}"
+        np.save(path, np.array(entries, dtype=packed_dataset.MANIFEST_DTYPE))
+    packed_dataset.build_manifest(destination_path)
+    print(f"Time taken: {time.time() - start_time:.2f} seconds")
+
+
+def _write_chunk(task):
+    filename, ranges, chunk_size, dtype, codec, sep_token = task
+    arr = np.full(chunk_size, sep_token, dtype=dtype)
+    doc_starts, doc_sources = [], []
+    has_doc_index = True
+    n_tokens = 0
+    for path, lo, hi, offset in ranges:
+        chunk = packed_dataset.open_chunk(path)
+        tokens = chunk.read(lo, hi) if isinstance(chunk, packed_dataset.CompressedChunk) else chunk[lo:hi]
+        if dtype != tokens.dtype.type and len(tokens) and tokens.max() > np.iinfo(dtype).max:
+            raise ValueError(f"{path} has tokens that do not fit into {np.dtype(dtype).name}.")
+        arr[offset : offset + hi - lo] = tokens
+        packed_dataset.close_chunk(chunk)
+        n_tokens = offset + hi - lo
+
+        if not os.path.isfile(packed_dataset.doc_index_path(path)):
+            has_doc_index = False
+        elif has_doc_index:
+            starts, sources = packed_dataset.read_doc_index(path)
+            keep = (starts >= lo) & (starts < hi)
+            doc_starts.extend((starts[keep] - lo + offset).tolist())
+            doc_sources.extend(sources[keep].tolist())
+
+    is_sep = arr == sep_token
+    if has_doc_index:
+        packed_dataset.write_doc_index(filename, doc_starts, doc_sources)
+        n_docs = len(doc_starts)
+    else:
+        n_docs = np.count_nonzero(is_sep[1:] & ~is_sep[:-1]) + int(not is_sep[0])
+    tmp_filename = filename + ".tmp"
+    with open(tmp_filename, "wb") as f:
+        packed_dataset.write_chunk(f, arr, codec=codec)
+    os.replace(tmp_filename, filename)
+    n_sep = np.count_nonzero(is_sep)
+    return os.path.basename(filename), packed_dataset.code(dtype), chunk_size, n_tokens, n_docs, n_sep
+
+
+if __name__ == "__main__":
+    from jsonargparse import CLI
+
+    CLI(reshard)
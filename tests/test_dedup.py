@@ -0,0 +1,40 @@
+import threading
+
+import numpy as np
+
+from lit_gpt.dedup import DedupIndex
+
+
+def reference_add(index, hashes, owner, generation):
+    keep = []
+    for h in hashes:
+        stored = index.get(h)
+        keep.append(stored is None or (stored[0] == owner and stored[1] != generation))
+        if keep[-1]:
+            index[h] = (owner, generation)
+    return keep
+
+
+def test_add_matches_sequential_reference(tmp_path):
+    DedupIndex.create(str(tmp_path), capacity=8)
+    index = DedupIndex(str(tmp_path), threading.Lock())
+    reference = {}
+    rng = np.random.default_rng(0)
+    for step in range(40):
+        # few distinct low bits, so that most hashes start probing at the same slots and wrap around the table
+        hashes = (rng.integers(1, 60, 32) << 32) | rng.integers(0, 4, 32)
+        owner, generation = int(rng.integers(0, 3)), step // 10
+        keep = index.add(hashes.tolist(), owner, generation)
+        assert keep.tolist() == reference_add(reference, hashes.tolist(), owner, generation)
+    assert len(index) == len(reference)
+    assert index.capacity > 8
+
+
+def test_other_processes_follow_a_grown_table(tmp_path):
+    lock = threading.Lock()
+    DedupIndex.create(str(tmp_path), capacity=4)
+    first, second = DedupIndex(str(tmp_path), lock), DedupIndex(str(tmp_path), lock)
+    assert first.add(list(range(1, 20)), owner=0, generation=0).all()
+    assert not second.add(list(range(1, 20)), owner=1, generation=0).any()
+    assert len(first) == len(second) == 19
+    assert first.capacity == second.capacity
@@ -0,0 +1,48 @@
+import numpy as np
+import pytest
+
+from lit_gpt.packed_dataset import MixtureSchedule, PackedDataset, PackedDatasetBuilder
+
+
+@pytest.mark.parametrize("weights", [[0.69, 0.31], [0.5, 0.3, 0.2], [0.7, 0.0, 0.2999, 0.0001]])
+def test_stratified_mixture_holds_on_every_prefix(weights):
+    schedule = MixtureSchedule(weights, seed=0, window_size=512)
+    sources = schedule.sources(0, 20000)
+
+    counts = np.cumsum(np.eye(len(weights), dtype=np.int64)[sources], axis=0)
+    expected = np.outer(np.arange(1, len(sources) + 1), np.asarray(weights) / sum(weights))
+    assert np.abs(counts - expected).max() < 1
+
+    # short windows anywhere in the schedule, not only from its start
+    for start in range(0, 20000, 100):
+        window = np.bincount(sources[start : start + 100], minlength=len(weights))
+        assert np.abs(window - 100 * np.asarray(weights)).max() < 2
+
+
+def test_stratified_mixture_is_position_addressable():
+    weights = [0.5, 0.3, 0.2]
+    sources = MixtureSchedule(weights, seed=0, window_size=512).sources(0, 5000)
+
+    schedule = MixtureSchedule(weights, seed=0, window_size=512)
+    assert np.array_equal(schedule.sources(1234, 1000), sources[1234:2234])
+    for start, n in [(0, 1), (511, 2), (100, 3000), (4000, 0)]:
+        assert np.array_equal(schedule.counts(start, n), np.bincount(sources[start : start + n], minlength=3))
+
+
+def test_shards_read_every_file(tmp_path):
+    builder = PackedDatasetBuilder(tmp_path, "x", chunk_size=40, sep_token=0, dtype=np.uint16)
+    for i in range(1, 24):
+        builder.add_array(np.full(40, i, dtype=np.uint16))
+    filenames = sorted(str(path) for path in tmp_path.glob("*.bin"))
+
+    seen = set()
+    for rank in range(2):
+        dataset = PackedDataset(filenames, n_chunks=3, block_size=10, seed=0, num_processes=2, process_rank=rank)
+        for worker_id in range(3):
+            # the files don't divide into 6 shards, nor the files of a shard into windows of 3
+            iterator = dataset._iterator(worker_id, 3)
+            n_files = len(iterator._filenames)
+            values = {int(next(iterator)[0]) for _ in range(4 * n_files)}
+            assert len(values) == n_files
+            seen |= values
+    assert seen == set(range(1, len(filenames) + 1))
@@ -0,0 +1,34 @@
+import json
+
+import numpy as np
+
+from lit_gpt.packed_dataset import PackedDatasetBuilder, build_manifest
+from scripts.packed_stats import _prefix_of, stats
+
+
+def test_prefix_of_pipeline_chunks():
+    assert _prefix_of("train_slimpajama_0000000003.bin", None) == "train_slimpajama"
+    assert _prefix_of("train_slimpajama_0123456789abcdef_0000000003.bin", None) == "train_slimpajama"
+    assert _prefix_of("train_slimpajama_9876543210123456_0000000000.bin", None) == "train_slimpajama"
+    assert _prefix_of("train_slimpajama_tails_0000000001.bin", None) == "train_slimpajama"
+    assert _prefix_of("train_starcoder_0123456789abcdef_0000000003.bin", ["train_star"]) == "train_star"
+
+
+def test_stats_groups_pipeline_chunks_by_prefix(tmp_path):
+    rng = np.random.default_rng(0)
+    for name in ("train_x_0123456789abcdef", "train_x_fedcba9876543210", "train_x_tails"):
+        builder = PackedDatasetBuilder(tmp_path, name, chunk_size=64, sep_token=1, dtype=np.uint16)
+        for _ in range(5):
+            builder.add_array(rng.integers(2, 100, 30).astype(np.uint16))
+        if name.endswith("tails"):
+            builder.write_reminder()
+        builder.write_manifest()
+    build_manifest(tmp_path)
+
+    output = tmp_path / "stats.json"
+    stats(data_dir=tmp_path, output=output, vocab_size=100, num_processes=1)
+    with open(output) as f:
+        result = json.load(f)
+    assert list(result["prefixes"]) == ["train_x"]
+    assert result["prefixes"]["train_x"]["n_chunks"] == 7
+    assert result["anomalies"] == []